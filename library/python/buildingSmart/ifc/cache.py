@@ -0,0 +1,118 @@
+"""
+On-disk cache of ifc extraction results
+
+The same ifc revision is often extracted again (retries, rules changes, webhooks firing twice).
+The results of extract_ifc_file are kept as parquet files, keyed by:
+- the sha256 of the ifc file content
+- the requested ifc types
+- functions.EXTRACTOR_VERSION, which changes whenever the extraction output changes
+
+so that a hit does not need the ifc file to be parsed at all.
+The least recently used entries are removed when the cache grows over its maximum size.
+
+Needs the optional pyarrow package.
+"""
+
+# packages
+import os
+import json
+import hashlib
+import tempfile
+import pandas as pd
+
+# from repo
+import library.python.pandas.functions as pf
+import library.python.buildingSmart.ifc.functions as ifc_functions
+
+
+class ExtractionCache:
+    def __init__(self, directory: str, max_size: int = 2 * 1024 * 1024 * 1024):
+        """
+        Input
+        -----
+        - directory: created if it does not exist
+        - max_size: maximum total size of the cache files in bytes
+        """
+        if pf.pq is None:
+            raise Exception("pyarrow is required for the extraction cache: pip install pyarrow")
+
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, content_hash: str, ifc_types: list) -> str:
+        key_data = {
+            "contentHash": content_hash,
+            "ifcTypes": list(ifc_types),
+            "extractorVersion": ifc_functions.EXTRACTOR_VERSION,
+        }
+        return hashlib.sha256(json.dumps(key_data).encode("utf-8")).hexdigest()
+
+    def get_path(self, content_hash: str, ifc_types: list) -> str:
+        return os.path.join(self.directory, f"{self.get_key(content_hash=content_hash, ifc_types=ifc_types)}.parquet")
+
+    def get(self, content_hash: str, ifc_types: list):
+        """
+        Output
+        ------
+        - (result_df, header_row) if the extraction is in the cache, otherwise None
+        """
+        path = self.get_path(content_hash=content_hash, ifc_types=ifc_types)
+        try:
+            table = pf.pq.read_table(path)
+        except (FileNotFoundError, OSError):
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        metadata = table.schema.metadata or {}
+        header_row = json.loads(metadata.get(b"header", b"{}"))
+        print(f"extraction cache hit: {content_hash}")
+        return pf.arrow_to_dataframe(table=table), header_row
+
+    def put(self, content_hash: str, ifc_types: list, result_df: pd.DataFrame, header_row: dict = {}):
+        table = pf.dataframe_to_arrow(input_df=result_df)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b"header"] = json.dumps(header_row, default=str).encode("utf-8")
+        table = table.replace_schema_metadata(metadata)
+
+        # write to a temporary file first, so that readers never see a partly written entry
+        path = self.get_path(content_hash=content_hash, ifc_types=ifc_types)
+        file_descriptor, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(file_descriptor)
+        try:
+            pf.pq.write_table(table, temp_path)
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is at most max_size bytes
+        """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".parquet"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+            total_size = total_size - size
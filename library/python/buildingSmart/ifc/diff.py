@@ -0,0 +1,175 @@
+"""
+Element level change detection between extractions of an ifc model
+
+Each extracted element gets a stable hash of its values (GlobalId, attributes, property sets, ...).
+Comparing the new rows with the rows already in Morta gives the elements which were added, removed
+or changed, so that only those are pushed instead of deleting and inserting every row again.
+"""
+
+# packages
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+# from repo
+import library.python.morta.api as ma
+
+ELEMENT_HASH_COLUMN = "Element Hash"
+
+# columns which do not describe the element itself:
+# step ids ("Attributes - id" and the "<Pset> - id" columns) change every time a model is exported
+IGNORED_COLUMNS = ["Attributes - id", "Revision Id", "Key", "File Name", ELEMENT_HASH_COLUMN]
+IGNORED_COLUMN_SUFFIXES = [" - id"]
+
+
+def normalize_value(value):
+    # missing values, and numbers which went through json or Morta, compare equal
+    if value is None or value == "":
+        return None
+    if isinstance(value, float):
+        if np.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    if isinstance(value, np.generic):
+        return normalize_value(value=value.item())
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+def is_hashed_column(column_name: str) -> bool:
+    if column_name in IGNORED_COLUMNS:
+        return False
+    return not any(column_name.endswith(suffix) for suffix in IGNORED_COLUMN_SUFFIXES)
+
+
+def get_element_hash(row: dict) -> str:
+    """
+    Purpose
+    -------
+    Gets a hash of the values of an extracted element which stays the same between extractions
+    as long as the element does not change
+
+    Input
+    -----
+    - row: {"column name": value}, one row of extract_ifc_file
+
+    Output
+    ------
+    - sha1 hex digest
+    """
+    values = {}
+    for column_name, value in row.items():
+        value = normalize_value(value=value)
+        if value is not None and is_hashed_column(column_name=column_name):
+            values[column_name] = value
+    text = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def add_element_hashes(input_df: pd.DataFrame, hash_column: str = ELEMENT_HASH_COLUMN) -> pd.DataFrame:
+    """
+    Adds the hash column (see get_element_hash) to the results of extract_ifc_file
+    """
+    column_names = list(input_df.columns.values)
+    input_df[hash_column] = [
+        get_element_hash(row=dict(zip(column_names, values))) for values in input_df.itertuples(index=False, name=None)
+    ]
+    return input_df
+
+
+def diff_element_rows(new_rows: list, previous_rows: list, key_column: str, hash_column: str) -> dict:
+    """
+    Purpose
+    -------
+    Compares the new rows of a model with the rows already in a Morta table
+
+    Input
+    -----
+    - new_rows: [{"rowData": {...}}], for example from pandas/functions.dataframe_to_morta_rows
+    - previous_rows: [{"publicId": ..., "rowData": {...}}], from morta.api.get_table_rows
+    - key_column: column identifying an element in both, for example "Key" or "Attributes - GlobalId"
+    - hash_column: column with the element hash in both
+
+    Output
+    ------
+    - {
+        "added": [{"rowData": {...}}],
+        "removed": [{"publicId": ..., "rowData": {...}}],
+        "changed": [{"publicId": ..., "rowData": {...}, "changedColumns": [...]}],
+        "unchangedCount": int,
+      }
+    """
+    previous_by_key = {}
+    removed = []
+    for previous_row in previous_rows:
+        key = previous_row["rowData"].get(key_column)
+        # rows without a key, or a second row with the same key, cannot be matched
+        if key is None or key in previous_by_key:
+            removed.append(previous_row)
+        else:
+            previous_by_key[key] = previous_row
+
+    added = []
+    changed = []
+    unchanged_count = 0
+    for new_row in new_rows:
+        key = new_row["rowData"].get(key_column)
+        previous_row = previous_by_key.pop(key, None) if key is not None else None
+        if previous_row is None:
+            added.append(new_row)
+            continue
+
+        if previous_row["rowData"].get(hash_column) == new_row["rowData"].get(hash_column):
+            unchanged_count = unchanged_count + 1
+            continue
+
+        changed_columns = get_changed_columns(
+            new_row_data=new_row["rowData"], previous_row_data=previous_row["rowData"]
+        )
+        changed.append(
+            {"publicId": previous_row["publicId"], "rowData": new_row["rowData"], "changedColumns": changed_columns}
+        )
+
+    removed.extend(previous_by_key.values())
+    return {"added": added, "removed": removed, "changed": changed, "unchangedCount": unchanged_count}
+
+
+def get_changed_columns(new_row_data: dict, previous_row_data: dict) -> list:
+    # columns of the table the new row does not have are emptied
+    column_names = list(new_row_data.keys()) + [key for key in previous_row_data if key not in new_row_data]
+    return [
+        column_name
+        for column_name in column_names
+        if normalize_value(value=new_row_data.get(column_name))
+        != normalize_value(value=previous_row_data.get(column_name))
+    ]
+
+
+def push_element_changes(table_id: str, changes: dict, api_key: str = None):
+    """
+    Pushes the result of diff_element_rows to the Morta table the previous rows came from:
+    removed rows are deleted, added rows are inserted and only the changed cells are updated
+    """
+    removed_row_ids = [row["publicId"] for row in changes["removed"]]
+    if len(removed_row_ids) > 0:
+        ma.delete_rows(table_id=table_id, row_ids=removed_row_ids, api_key=api_key)
+
+    if len(changes["added"]) > 0:
+        ma.insert_rows(table_id=table_id, rows=changes["added"], api_key=api_key)
+
+    cells = [
+        {"rowId": row["publicId"], "columnName": column_name, "value": row["rowData"].get(column_name)}
+        for row in changes["changed"]
+        for column_name in row["changedColumns"]
+    ]
+    if len(cells) > 0:
+        ma.update_cells(table_id=table_id, cells=cells, api_key=api_key)
+
+    print(
+        f"pushed element changes to table: {table_id}, added: {str(len(changes['added']))}, "
+        f"removed: {str(len(removed_row_ids))}, changed: {str(len(changes['changed']))}, "
+        f"unchanged: {str(changes['unchangedCount'])}"
+    )
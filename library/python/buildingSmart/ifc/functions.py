@@ -1,25 +1,53 @@
 # packages
+import os
 import json
 import time
 import numpy
+import tempfile
+import functools
+import contextvars
 import logging
-import regex as re
 import ifcopenshell
+import multiprocessing
 import pandas as pd
+from typing import Iterator
 from ifcopenshell.util import classification as ifc_classification
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 # custom
 import library.python.morta.api as ma
+import library.python.morta.rows as mr
 import library.python.morta.functions as mf
 import library.python.pandas.functions as pf
+import library.python.pandas.columnar as pc
 import library.python.viewpoint.api as vp_api
 import library.python.viewpoint.config as config
 import library.python.morta.passthrough.viewpoint as mva
+import library.python.buildingSmart.ifc.indexes as ifc_indexes
+import library.python.buildingSmart.ifc.rules as ifc_rules
 
 logger = logging.getLogger("app")
 
+# version of the output of extract_ifc_file. change it whenever the extracted columns or values change,
+# so that results cached by buildingSmart/ifc/cache.py are not reused
+EXTRACTOR_VERSION = "1"
 
-def extract_ifc_files(ifc_files: list, ifc_types: list, file_name_column: str = "File Name") -> pd.DataFrame:
+# rough memory used by ifcopenshell per byte of ifc file, used to limit the number of extraction workers
+IFC_MEMORY_PER_FILE_BYTE = 10
+
+# rules added for every element type with a type, and with a classification
+RELATING_TYPE_PROPERTIES = ["Element Type", "Name", "Description", "GlobalId", "PredefinedType"]
+CLASSIFICATION_PROPERTIES = ["Name", "ItemReference", "ItemName"]
+
+# the ifc file opened in each worker process of extract_ifc_file_sharded, and its indexes
+_shard_ifc_file = None
+_shard_spatial_index = None
+_shard_relationship_index = None
+
+
+def extract_ifc_files(
+    ifc_files: list, ifc_types: list, file_name_column: str = "File Name", tag_column: str = None
+) -> pd.DataFrame:
     """
     Purpose
     -------
@@ -30,25 +58,96 @@ def extract_ifc_files(ifc_files: list, ifc_types: list, file_name_column: str =
     - ifc_files: [{"fileName": file_name, "ifcFile": ifc_file}]
         - where ifc_file is the result of ifcopenshell.open function
     - ifc_types: list of str. ifc types examples: IfcDoor, IfcWindow, etc.
+    - tag_column: see extract_ifc_file
     """
     # initialize variables
-    result_dfs = []
+    builder = pc.ColumnarBuilder(column_names=[file_name_column])
 
     # loop over files and append their extraction results
     for ifc_file_data in ifc_files:
         file_name = ifc_file_data["fileName"]
         ifc_file = ifc_file_data["ifcFile"]
 
-        current_df = extract_ifc_file(ifc_file=ifc_file, ifc_types=ifc_types)
-        current_df.insert(loc=0, column=file_name_column, value=file_name)
-        result_dfs.append(current_df)
+        current_builder = extract_ifc_file_to_builder(ifc_file=ifc_file, ifc_types=ifc_types, tag_column=tag_column)
+        builder.extend(other=current_builder, constants={file_name_column: file_name})
 
     # return combined dataframe
-    result_df = pd.concat(objs=result_dfs)
+    result_df = builder.to_dataframe()
     return result_df
 
 
-def extract_ifc_file(ifc_file: ifcopenshell.file, ifc_types: list) -> pd.DataFrame:
+def extract_ifc_files_in_parallel(
+    ifc_files: list,
+    ifc_types: list,
+    file_name_column: str = "File Name",
+    max_workers: int = None,
+    tag_column: str = None,
+) -> pd.DataFrame:
+    """
+    Purpose
+    -------
+    Same as extract_ifc_files, but each file is opened and extracted in its own worker process,
+    so several models are extracted at the same time on different cores
+
+    Input
+    -----
+    - ifc_files: [{"fileName": file_name, "filePath": file_path}]
+        - where file_path is the path of the ifc file on disk
+    - ifc_types: list of str. ifc types examples: IfcDoor, IfcWindow, etc.
+    - max_workers: number of worker processes. defaults to the number of cpus
+    - tag_column: see extract_ifc_file
+
+    Output
+    ------
+    - pandas dataframe, with the files in the same order as ifc_files
+    """
+    if len(ifc_files) == 0:
+        return pd.DataFrame()
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(ifc_files)))
+
+    # the workers only receive the file paths: ifcopenshell files cannot be sent between processes
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                extract_ifc_file_to_columns,
+                file_path=ifc_file_data["filePath"],
+                ifc_types=ifc_types,
+                tag_column=tag_column,
+            )
+            for ifc_file_data in ifc_files
+        ]
+
+        # merge the results in the order of the files
+        builder = pc.ColumnarBuilder(column_names=[file_name_column])
+        for ifc_file_data, future in zip(ifc_files, futures):
+            builder.extend(other=future.result(), constants={file_name_column: ifc_file_data["fileName"]})
+
+    # return combined dataframe
+    result_df = builder.to_dataframe()
+    return result_df
+
+
+def extract_ifc_file_to_columns(file_path: str, ifc_types: list, tag_column: str = None) -> pc.ColumnarBuilder:
+    """
+    Purpose
+    -------
+    Opens and extracts one ifc file (used as a worker by extract_ifc_files_in_parallel)
+
+    Output
+    ------
+    - the columns of the extraction, which are much smaller to send back to the parent process
+      than one dict per element
+    """
+    ifc_file = ifcopenshell.open(file_path)
+    return extract_ifc_file_to_builder(ifc_file=ifc_file, ifc_types=ifc_types, tag_column=tag_column)
+
+
+def extract_ifc_file(
+    ifc_file: ifcopenshell.file, ifc_types: list, categorical: bool = False, tag_column: str = None
+) -> pd.DataFrame:
     """
     Purpose
     -------
@@ -64,35 +163,381 @@ def extract_ifc_file(ifc_file: ifcopenshell.file, ifc_types: list) -> pd.DataFra
     -----
     - ifc_file is the result of ifcopenshell.open function
     - ifc_types: list of str. ifc types examples: IfcDoor, IfcWindow, etc.
+        - each element is extracted once, even if it matches several of the types
+          (for example IfcFlowTerminal and its subtype IfcAirTerminal), see plan_extraction
+    - categorical (optional): store low-cardinality text columns (storeys, type names, etc.) as pandas categoricals,
+      to save memory when the dataframe is only read or written to a file
+    - tag_column (optional): name of a column listing the requested types each element matches
     """
-    results = []
-    # loop over ifc_types
+    builder = extract_ifc_file_to_builder(ifc_file=ifc_file, ifc_types=ifc_types, tag_column=tag_column)
+    return builder.to_dataframe(categorical=categorical)
+
+
+def extract_ifc_file_to_builder(
+    ifc_file: ifcopenshell.file, ifc_types: list, tag_column: str = None
+) -> pc.ColumnarBuilder:
+    """
+    Purpose
+    -------
+    Extracts a file into a columnar builder: each element is appended into the columns as soon
+    as it is extracted, instead of keeping one dict per element
+
+    Input
+    -----
+    - same as extract_ifc_file
+    """
+    builder = pc.ColumnarBuilder()
+    spatial_index = ifc_indexes.SpatialIndex(ifc_file=ifc_file)
+    relationship_index = ifc_indexes.RelationshipIndex(ifc_file=ifc_file)
+    # loop over the elements of ifc_types
+    element: ifcopenshell.entity_instance
+    for element, matched_types in iter_planned_elements(ifc_file=ifc_file, ifc_types=ifc_types):
+        element_result = extract_element(
+            element=element, spatial_index=spatial_index, relationship_index=relationship_index
+        )
+        if tag_column:
+            element_result[tag_column] = matched_types
+        builder.append(row=element_result)
+
+    return builder
+
+
+def plan_extraction(schema: str, ifc_types: list) -> list:
+    """
+    Purpose
+    -------
+    Collapses the requested ifc types to the types whose elements need to be read:
+    a type which is a subtype of another requested type is dropped, because
+    ifc_file.by_type(supertype) already returns its elements
+
+    Input
+    -----
+    - schema: schema of the file, for example ifc_file.schema
+    - ifc_types: list of str. ifc types examples: IfcDoor, IfcWindow, etc.
+
+    Output
+    ------
+    - list of str, in the order of ifc_types
+    """
+    unique_types = get_unique_ifc_types(ifc_types=ifc_types)
+    return [
+        ifc_type
+        for ifc_type in unique_types
+        if not any(
+            other_type != ifc_type and is_subtype(schema=schema, ifc_type=ifc_type, super_type=other_type)
+            for other_type in unique_types
+        )
+    ]
+
+
+def get_unique_ifc_types(ifc_types: list) -> list:
+    # by_type does not care about the case of the type names
+    unique_types = {}
     for ifc_type in ifc_types:
-        elements = ifc_file.by_type(type=ifc_type)
-        element: ifcopenshell.entity_instance
-        for element in elements:
-            element_result = extract_element(element=element)
-            results.append(element_result)
+        unique_types.setdefault(ifc_type.lower(), ifc_type)
+    return list(unique_types.values())
+
+
+def is_subtype(schema: str, ifc_type: str, super_type: str) -> bool:
+    try:
+        declaration = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema).declaration_by_name(ifc_type)
+    except RuntimeError:
+        # unknown schema or type: it is kept, and by_type reports the error
+        return False
 
-    return pd.DataFrame(data=results)
+    entity = declaration.as_entity()
+    while entity is not None:
+        if entity.name().lower() == super_type.lower():
+            return True
+        entity = entity.supertype()
+    return False
+
+
+def iter_planned_elements(ifc_file: ifcopenshell.file, ifc_types: list) -> Iterator:
+    """
+    Purpose
+    -------
+    Yields each element of the requested ifc types once, see plan_extraction
+
+    Output
+    ------
+    - iterator of (element, matched_types)
+        - matched_types: the requested types the element is an instance of
+    """
+    requested_types = get_unique_ifc_types(ifc_types=ifc_types)
+    matched_types_by_class = {}
+    extracted_ids = set()
+
+    for ifc_type in plan_extraction(schema=ifc_file.schema, ifc_types=ifc_types):
+        for element in ifc_file.by_type(type=ifc_type):
+            # types that could not be collapsed (unknown to the schema) can still overlap
+            element_id = element.id()
+            if element_id in extracted_ids:
+                continue
+            extracted_ids.add(element_id)
+
+            element_class = element.is_a()
+            matched_types = matched_types_by_class.get(element_class)
+            if matched_types is None:
+                matched_types = [requested for requested in requested_types if element.is_a(requested)]
+                matched_types_by_class[element_class] = matched_types
+            yield element, list(matched_types)
+
+
+def iter_extract_ifc_file(
+    ifc_file: ifcopenshell.file,
+    ifc_types: list,
+    chunk_size: int = 5000,
+    categorical: bool = False,
+    as_arrow: bool = False,
+    tag_column: str = None,
+) -> Iterator:
+    """
+    Purpose
+    -------
+    Same as extract_ifc_file, but yields the result in chunks of at most chunk_size elements,
+    so the extraction of a whole model is never held in memory
+
+    Chunks do not all have the same columns: a chunk only has the columns of its elements.
+    The chunks can be passed to the sinks in pandas/functions.py:
+    - write_chunks_to_parquet
+    - write_chunks_to_ndjson
+    - insert_chunks_into_table
+
+    Input
+    -----
+    - ifc_file is the result of ifcopenshell.open function
+    - ifc_types: list of str. ifc types examples: IfcDoor, IfcWindow, etc.
+    - chunk_size: maximum number of elements per chunk
+    - categorical: see extract_ifc_file
+    - as_arrow: yield pyarrow tables (see pandas/functions.dataframe_to_arrow) instead of dataframes
+    - tag_column: see extract_ifc_file
+
+    Output
+    ------
+    - iterator of pandas dataframes or pyarrow tables
+    """
+    for builder in iter_extract_ifc_file_to_builders(
+        ifc_file=ifc_file, ifc_types=ifc_types, chunk_size=chunk_size, tag_column=tag_column
+    ):
+        result_df = builder.to_dataframe(categorical=categorical)
+        yield pf.dataframe_to_arrow(input_df=result_df) if as_arrow else result_df
+
+
+def iter_extract_ifc_files(
+    ifc_files: list,
+    ifc_types: list,
+    file_name_column: str = "File Name",
+    chunk_size: int = 5000,
+    categorical: bool = False,
+    as_arrow: bool = False,
+    tag_column: str = None,
+) -> Iterator:
+    """
+    Purpose
+    -------
+    Same as extract_ifc_files, but yields the result in chunks, see iter_extract_ifc_file
+
+    Input
+    -----
+    - ifc_files: [{"fileName": file_name, "ifcFile": ifc_file}] or [{"fileName": file_name, "filePath": file_path}]
+        - files given by path are opened one at a time, and released before the next one is opened
+    """
+    for ifc_file_data in ifc_files:
+        file_name = ifc_file_data["fileName"]
+        ifc_file = ifc_file_data.get("ifcFile") or ifcopenshell.open(ifc_file_data["filePath"])
+
+        for builder in iter_extract_ifc_file_to_builders(
+            ifc_file=ifc_file, ifc_types=ifc_types, chunk_size=chunk_size, tag_column=tag_column
+        ):
+            chunk_builder = pc.ColumnarBuilder(column_names=[file_name_column])
+            chunk_builder.extend(other=builder, constants={file_name_column: file_name})
+            result_df = chunk_builder.to_dataframe(categorical=categorical)
+            yield pf.dataframe_to_arrow(input_df=result_df) if as_arrow else result_df
+
+        del ifc_file
+
+
+def iter_extract_ifc_file_to_builders(
+    ifc_file: ifcopenshell.file, ifc_types: list, chunk_size: int, tag_column: str = None
+) -> Iterator:
+    builder = pc.ColumnarBuilder()
+    spatial_index = ifc_indexes.SpatialIndex(ifc_file=ifc_file)
+    relationship_index = ifc_indexes.RelationshipIndex(ifc_file=ifc_file)
+    for element, matched_types in iter_planned_elements(ifc_file=ifc_file, ifc_types=ifc_types):
+        element_result = extract_element(
+            element=element, spatial_index=spatial_index, relationship_index=relationship_index
+        )
+        if tag_column:
+            element_result[tag_column] = matched_types
+        builder.append(row=element_result)
+        if len(builder) >= chunk_size:
+            yield builder
+            builder = pc.ColumnarBuilder()
+
+    if len(builder) > 0:
+        yield builder
+
+
+def extract_ifc_file_sharded(
+    file_path: str,
+    ifc_types: list,
+    max_workers: int = None,
+    shard_size: int = 5000,
+    ifc_file: ifcopenshell.file = None,
+    tag_column: str = None,
+) -> pd.DataFrame:
+    """
+    Purpose
+    -------
+    Same as extract_ifc_file, but the elements of one (large) file are split in shards of
+    shard_size elements which are extracted by several worker processes
+
+    Where the platform supports it, the workers are forked after the file is opened and share it.
+    Otherwise each worker opens its own copy of the file.
+    The number of workers is limited by the available memory, see get_memory_aware_worker_count.
+
+    Input
+    -----
+    - file_path: path of the ifc file on disk
+    - ifc_types: list of str. ifc types examples: IfcDoor, IfcWindow, etc.
+    - max_workers: maximum number of worker processes. defaults to the number of cpus
+    - shard_size: number of elements extracted by a worker at a time
+    - ifc_file: the file already opened with ifcopenshell.open, if available
+    - tag_column: see extract_ifc_file
+
+    Output
+    ------
+    - pandas dataframe, with the elements in the same order as extract_ifc_file
+    """
+    global _shard_ifc_file
+    global _shard_spatial_index
+    global _shard_relationship_index
+
+    if ifc_file is None:
+        ifc_file = ifcopenshell.open(file_path)
+
+    # element ids (and the requested types they match) in the order extract_ifc_file extracts them
+    planned_elements = [
+        (element.id(), matched_types)
+        for element, matched_types in iter_planned_elements(ifc_file=ifc_file, ifc_types=ifc_types)
+    ]
+    shards = [planned_elements[i : i + shard_size] for i in range(0, len(planned_elements), shard_size)]
+
+    can_fork = "fork" in multiprocessing.get_all_start_methods()
+    max_workers = get_memory_aware_worker_count(file_path=file_path, max_workers=max_workers, shared=can_fork)
+    max_workers = min(max_workers, len(shards))
+    if max_workers <= 1:
+        return extract_ifc_file(ifc_file=ifc_file, ifc_types=ifc_types, tag_column=tag_column)
+
+    # forked workers inherit the opened file and its indexes, spawned workers open and index it in init_shard_worker
+    if can_fork:
+        _shard_ifc_file = ifc_file
+        _shard_spatial_index = ifc_indexes.SpatialIndex(ifc_file=ifc_file)
+        _shard_relationship_index = ifc_indexes.RelationshipIndex(ifc_file=ifc_file)
+    try:
+        mp_context = multiprocessing.get_context("fork" if can_fork else "spawn")
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=mp_context,
+            initializer=init_shard_worker,
+            initargs=(file_path,),
+        ) as executor:
+            # map returns the results in the order of the shards
+            builder = pc.ColumnarBuilder()
+            for shard_builder in executor.map(functools.partial(extract_shard, tag_column=tag_column), shards):
+                builder.extend(other=shard_builder)
+    finally:
+        _shard_ifc_file = None
+        _shard_spatial_index = None
+        _shard_relationship_index = None
+
+    result_df = builder.to_dataframe()
+    return result_df
+
+
+def init_shard_worker(file_path: str):
+    global _shard_ifc_file
+    global _shard_spatial_index
+    global _shard_relationship_index
+
+    # forked workers already have the file and its indexes
+    if _shard_ifc_file is None:
+        _shard_ifc_file = ifcopenshell.open(file_path)
+        _shard_spatial_index = ifc_indexes.SpatialIndex(ifc_file=_shard_ifc_file)
+        _shard_relationship_index = ifc_indexes.RelationshipIndex(ifc_file=_shard_ifc_file)
+
+
+def extract_shard(planned_elements: list, tag_column: str = None) -> pc.ColumnarBuilder:
+    builder = pc.ColumnarBuilder()
+    for element_id, matched_types in planned_elements:
+        element_result = extract_element(
+            element=_shard_ifc_file.by_id(element_id),
+            spatial_index=_shard_spatial_index,
+            relationship_index=_shard_relationship_index,
+        )
+        if tag_column:
+            element_result[tag_column] = matched_types
+        builder.append(row=element_result)
+    return builder
+
+
+def get_memory_aware_worker_count(file_path: str, max_workers: int = None, shared: bool = False) -> int:
+    """
+    Purpose
+    -------
+    Gets the number of extraction workers which fit in the available memory
+
+    Each worker is expected to use IFC_MEMORY_PER_FILE_BYTE bytes per byte of the ifc file.
+    Forked workers (shared=True) share the file opened by the parent, but still end up copying
+    part of it, so they are counted as half a file each.
+
+    Input
+    -----
+    - file_path: path of the ifc file on disk
+    - max_workers: maximum number of workers. defaults to the number of cpus
+    - shared: whether the workers share the file opened by the parent process
+
+    Output
+    ------
+    - int, at least 1
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    try:
+        available_memory = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        # the available memory is not known on this platform
+        return max(1, max_workers)
+
+    memory_per_worker = os.path.getsize(file_path) * IFC_MEMORY_PER_FILE_BYTE
+    if shared:
+        memory_per_worker = memory_per_worker // 2
+    if memory_per_worker <= 0:
+        return max(1, max_workers)
+
+    return max(1, min(max_workers, available_memory // memory_per_worker))
 
 
 def extract_element(
     element: ifcopenshell.entity_instance,
     spatial_container_properties: list = ["Name", "LongName"],
+    spatial_index: ifc_indexes.SpatialIndex = None,
+    relationship_index: ifc_indexes.RelationshipIndex = None,
 ) -> dict:
     # get spatial containers
     spatial_breakdown: dict = get_spatial_containers(
-        element=element, properties=spatial_container_properties
+        element=element, properties=spatial_container_properties, spatial_index=spatial_index
     )
     # get attributes
     attributes: dict = get_attributes(element=element)
     # get quantities and property sets and properties
-    properties: dict = get_properties(element=element)
+    properties: dict = get_properties(element=element, relationship_index=relationship_index)
     # get classification
-    classifications: dict = get_classficiations(element=element)
+    classifications: dict = get_classficiations(element=element, relationship_index=relationship_index)
     # get relating type
-    relating_type: dict = get_relating_type(element=element)
+    relating_type: dict = get_relating_type(element=element, relationship_index=relationship_index)
 
     return {
         **spatial_breakdown,
@@ -104,8 +549,14 @@ def extract_element(
 
 
 def get_spatial_containers(
-    element: ifcopenshell.entity_instance, properties: list = ["Name", "LongName"]
+    element: ifcopenshell.entity_instance,
+    properties: list = ["Name", "LongName"],
+    spatial_index: ifc_indexes.SpatialIndex = None,
 ) -> dict:
+    # the index of the file keeps the chains of containers already formatted
+    if spatial_index is not None:
+        return spatial_index.get_spatial_containers(element=element, properties=properties)
+
     properties = list(reversed(properties))
     result = {}
     container = ifcopenshell.util.element.get_container(element)
@@ -145,8 +596,13 @@ def get_attributes(element: ifcopenshell.entity_instance) -> dict:
     return result
 
 
-def get_properties(element: ifcopenshell.entity_instance) -> dict:
-    psets = ifcopenshell.util.element.get_psets(element=element, should_inherit=True)
+def get_properties(
+    element: ifcopenshell.entity_instance, relationship_index: ifc_indexes.RelationshipIndex = None
+) -> dict:
+    if relationship_index is not None:
+        psets = relationship_index.get_psets(element=element)
+    else:
+        psets = ifcopenshell.util.element.get_psets(element=element, should_inherit=True)
     results = {}
     for pset_name, properties in psets.items():
         for property_name, value in properties.items():
@@ -154,11 +610,19 @@ def get_properties(element: ifcopenshell.entity_instance) -> dict:
     return results
 
 
-def get_classficiations(element: ifcopenshell.entity_instance) -> dict:
+def get_classficiations(
+    element: ifcopenshell.entity_instance, relationship_index: ifc_indexes.RelationshipIndex = None
+) -> dict:
     results = {}
-    references = ifc_classification.get_references(element=element)
+    if relationship_index is not None:
+        references = relationship_index.get_references(element=element)
+    else:
+        references = ifc_classification.get_references(element=element)
     for reference in references:
-        info = reference.get_info(recursive=True)
+        if relationship_index is not None:
+            info = relationship_index.get_info(element=reference, recursive=True)
+        else:
+            info = reference.get_info(recursive=True)
         if info["ReferencedSource"]:
             source_name = info["ReferencedSource"]["Name"]
             classification_name = info["Name"]
@@ -172,11 +636,18 @@ def get_classficiations(element: ifcopenshell.entity_instance) -> dict:
 def get_relating_type(
     element: ifcopenshell.entity_instance,
     properties: list = ["type", "Name", "Description", "PredefinedType", "GlobalId"],
+    relationship_index: ifc_indexes.RelationshipIndex = None,
 ) -> dict:
     result = {}
-    relating_type = ifcopenshell.util.element.get_type(element=element)
+    if relationship_index is not None:
+        relating_type = relationship_index.get_type(element=element)
+    else:
+        relating_type = ifcopenshell.util.element.get_type(element=element)
     if relating_type:
-        info = relating_type.get_info()
+        if relationship_index is not None:
+            info = relationship_index.get_info(element=relating_type)
+        else:
+            info = relating_type.get_info()
         for prop in properties:
             if prop in info:
                 result[f"RelatingType - {prop}"] = info[prop]
@@ -241,6 +712,8 @@ def extract(
         contributor_tag_id=contributor_tag_id,
     )
 
+    spatial_index = ifc_indexes.SpatialIndex(ifc_file=ifc_file)
+
     for element_type, table_id in table_mapping.items():
         # initialize variables
         new_rows = []
@@ -255,62 +728,7 @@ def extract(
             row = {}
             row["Model Name"] = model_name
 
-            if hasattr(element, "ContainedInStructure"):
-                contained_in = element.ContainedInStructure
-                if len(contained_in) > 0:
-                    contained_in = contained_in[0]
-                    relating_structure = contained_in.RelatingStructure
-                    relating_structure_type = relating_structure.get_info()["type"]
-                    relating_structure_type_formatted = relating_structure_type.replace(
-                        "Ifc", ""
-                    )
-                    name_componenets = [
-                        relating_structure.Name if relating_structure.Name else ""
-                    ]
-                    if hasattr(relating_structure, "LongName"):
-                        if relating_structure.LongName:
-                            name_componenets.append(relating_structure.LongName)
-                    row[relating_structure_type_formatted] = " - ".join(
-                        name_componenets
-                    )
-
-                    while len(relating_structure.Decomposes) > 0:
-                        relating_structure = relating_structure.Decomposes[
-                            0
-                        ].RelatingObject
-                        relating_structure_type = relating_structure.get_info()["type"]
-                        relating_structure_type_formatted = (
-                            relating_structure_type.replace("Ifc", "")
-                        )
-                        name_componenets = [
-                            relating_structure.Name if relating_structure.Name else ""
-                        ]
-                        if hasattr(relating_structure, "LongName"):
-                            if relating_structure.LongName:
-                                name_componenets.append(relating_structure.LongName)
-                        row[relating_structure_type_formatted] = " - ".join(
-                            name_componenets
-                        )
-            else:
-                relating_structure = element
-                while (
-                    hasattr(relating_structure, "Decomposes")
-                    and len(relating_structure.Decomposes) > 0
-                ):
-                    relating_structure = relating_structure.Decomposes[0].RelatingObject
-                    relating_structure_type = relating_structure.get_info()["type"]
-                    relating_structure_type_formatted = relating_structure_type.replace(
-                        "Ifc", ""
-                    )
-                    name_componenets = [
-                        relating_structure.Name if relating_structure.Name else ""
-                    ]
-                    if hasattr(relating_structure, "LongName"):
-                        if relating_structure.LongName:
-                            name_componenets.append(relating_structure.LongName)
-                    row[relating_structure_type_formatted] = " - ".join(
-                        name_componenets
-                    )
+            row.update(spatial_index.get_structure_names(element=element))
 
             for key, value in element.__dict__.items():
                 colm_name = f"Attributes - {key}"
@@ -634,26 +1052,39 @@ def check_rules(
     values_list_table_id: str,
     admin_tag_id: str,
     contributor_tag_id: str,
+    result_mode: str = "full",
+    results_table_id: str = None,
+    results_batch_size: int = 2000,
+    state_directory: str = None,
+    max_workers: int = 1,
 ) -> pd.DataFrame:
     """
     Steps
     -----
     - get tables of each element type
     - get rows from each table
-    - for each row
-    - for each rule
-    - check if rule pset name and prop name are equal to one in row
-    - if yes, conduct checks
+    - index the rules of each element type by (Grouping, Attribute/ Property)
+    - check each rule on the whole column of its property (see rules.py)
+
+    Input
+    -----
+    - result_mode: "full", "failures", "summary" or "categorical", see rules.check_element_rules
+    - results_table_id: optional Morta table the results of each element type are inserted into
+      as soon as they are checked, results_batch_size rows at a time
+    - state_directory: optional directory keeping the results of the last run,
+      so that only the rows changed since are checked (see rules.IncrementalValidation)
+    - max_workers: more than 1 fetches and checks the element type tables in parallel,
+      see iter_check_tables_in_parallel
     """
     # initialize variables
-    acceptable_not_acceptable_values = ma.get_table_rows(table_id=values_list_table_id)
-    type_mapping = {
-        "str": "text",
-        "int": "integer",
-        "float": "decimal",
-        "bool": "boolean",
-        "list": "list",
-    }
+    value_list_index = ifc_rules.ValueListIndex(
+        value_list_rows=mr.get_table_rows_compact(table_id=values_list_table_id)
+    )
+    incremental_validation = None
+    if state_directory:
+        incremental_validation = ifc_rules.IncrementalValidation(
+            directory=state_directory
+        )
 
     if rules_df.empty:
         return
@@ -681,332 +1112,168 @@ def check_rules(
         contributor_tag_id=contributor_tag_id,
     )
 
-    results = []
-
+    table_rules = {}
     for element_type, table_id in table_mapping.items():
-        # initialize variables
         current_rules_df = rules_df.loc[rules_df["Element Type"] == element_type]
-        if current_rules_df.empty:
-            continue
-        rule_rows = pf.dataframe_to_list(input_df=current_rules_df)
-        element_rows = ma.get_table_rows(table_id=table_id)
-
-        for element in element_rows:
-            element = element["rowData"]
-            model_name = element["Model Name"]
-            element_guid = element["Attributes - GlobalId"]
-            for prop, value in element.items():
-                if prop in [
-                    "Model Name",
-                    "Project",
-                    "Building",
-                    "BuildingStorey",
-                    "Site",
-                    "Space",
-                    "Changed?",
-                ]:
-                    continue
-                pset_name = prop.split(" - ")[0]
-                prop_name = prop.split(" - ")[1]
-                for rule in rule_rows:
-                    rule_pset_name = rule["Grouping"]
-                    rule_prop_name = rule["Attribute/ Property"]
-                    if pset_name == rule_pset_name and rule_prop_name == prop_name:
-                        rule1 = rule["Should Exist"]
-                        rule2 = rule["Should have value"]
-                        rule3 = rule["Must be unique"]
-                        rule4 = rule["Value Regex Expression"]
-                        rule5 = rule["Should be one of the below"]
-                        rule6 = rule["Should not be one of below"]
-                        rule7 = rule["Data Type"]
-
-                        if rule1:
-                            if value == "Not Found":
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Should Exist",
-                                        "Result": "Fail",
-                                    }
-                                )
-                            else:
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Should Exist",
-                                        "Result": "Pass",
-                                    }
-                                )
-                        else:
-                            results.append(
-                                {
-                                    "Model Name": model_name,
-                                    "Element Type": element_type,
-                                    "Element ID": element_guid,
-                                    "Attribute/ Property": prop,
-                                    "Rule": "Should Exist",
-                                    "Result": "Check not required",
-                                }
-                            )
-
-                        if rule2:
-                            if value and value != "Not Found":
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Should have value",
-                                        "Result": "Pass",
-                                    }
-                                )
-                            else:
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Should have value",
-                                        "Result": "Fail",
-                                    }
-                                )
-                        else:
-                            results.append(
-                                {
-                                    "Model Name": model_name,
-                                    "Element Type": element_type,
-                                    "Element ID": element_guid,
-                                    "Attribute/ Property": prop,
-                                    "Rule": "Should have value",
-                                    "Result": "Check not required",
-                                }
-                            )
-
-                        if rule3:
-                            all_values = [
-                                current_element["rowData"][prop]
-                                for current_element in element_rows
-                                if prop in current_element["rowData"]
-                                and current_element["rowData"]["Model Name"]
-                                == model_name
-                            ]
-                            all_values = [
-                                current_value
-                                for current_value in all_values
-                                if current_value == value
-                            ]
-
-                            if len(all_values) == 1:
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Must by unique",
-                                        "Result": "Pass",
-                                    }
-                                )
-                            else:
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Must by unique",
-                                        "Result": "Fail",
-                                    }
-                                )
-                        else:
-                            results.append(
-                                {
-                                    "Model Name": model_name,
-                                    "Element Type": element_type,
-                                    "Element ID": element_guid,
-                                    "Attribute/ Property": prop,
-                                    "Rule": "Must by unique",
-                                    "Result": "Check not required",
-                                }
-                            )
-
-                        if rule4:
-                            expression = rule["Value Regex Expression"]
-                            if len(expression) > 0 and value:
-                                if re.match(expression, value):
-                                    results.append(
-                                        {
-                                            "Model Name": model_name,
-                                            "Element Type": element_type,
-                                            "Element ID": element_guid,
-                                            "Attribute/ Property": prop,
-                                            "Rule": "Value Regex Expression",
-                                            "Result": "Pass",
-                                        }
-                                    )
-                                else:
-                                    results.append(
-                                        {
-                                            "Model Name": model_name,
-                                            "Element Type": element_type,
-                                            "Element ID": element_guid,
-                                            "Attribute/ Property": prop,
-                                            "Rule": "Value Regex Expression",
-                                            "Result": "Fail",
-                                        }
-                                    )
-                            else:
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Value Regex Expression",
-                                        "Result": "Check not required",
-                                    }
-                                )
-                        else:
-                            results.append(
-                                {
-                                    "Model Name": model_name,
-                                    "Element Type": element_type,
-                                    "Element ID": element_guid,
-                                    "Attribute/ Property": prop,
-                                    "Rule": "Value Regex Expression",
-                                    "Result": "Check not required",
-                                }
-                            )
-
-                        if rule5:
-                            # get list of possible values
-                            values_list = [
-                                row
-                                for row in acceptable_not_acceptable_values
-                                if row["rowData"]["Element Type"] == element_type
-                                and row["rowData"]["Name"] == value
-                            ]
-                            values = [
-                                value["rowData"]["Value"] for value in values_list
-                            ]
-
-                            if value in values:
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Should be one of the below",
-                                        "Result": "Pass",
-                                    }
-                                )
-                            else:
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Should be one of the below",
-                                        "Result": "Fail",
-                                    }
-                                )
-                        else:
-                            results.append(
-                                {
-                                    "Model Name": model_name,
-                                    "Element Type": element_type,
-                                    "Element ID": element_guid,
-                                    "Attribute/ Property": prop,
-                                    "Rule": "Should be one of the below",
-                                    "Result": "Check not required",
-                                }
-                            )
-
-                        if rule6:
-                            # get list of possible values
-                            values_list = [
-                                row
-                                for row in acceptable_not_acceptable_values
-                                if row["rowData"]["Element Type"] == element_type
-                                and row["rowData"]["Name"] == value
-                            ]
-                            values = [
-                                value["rowData"]["Value"] for value in values_list
-                            ]
-
-                            if value in values:
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Should not be one of below",
-                                        "Result": "Fail",
-                                    }
-                                )
-                            else:
-                                results.append(
-                                    {
-                                        "Model Name": model_name,
-                                        "Element Type": element_type,
-                                        "Element ID": element_guid,
-                                        "Attribute/ Property": prop,
-                                        "Rule": "Should not be one of below",
-                                        "Result": "Pass",
-                                    }
-                                )
-                        else:
-                            results.append(
-                                {
-                                    "Model Name": model_name,
-                                    "Element Type": element_type,
-                                    "Element ID": element_guid,
-                                    "Attribute/ Property": prop,
-                                    "Rule": "Should not be one of below",
-                                    "Result": "Check not required",
-                                }
-                            )
-
-                        if rule7:
-                            value_type = str(type(value))
-                            value_type = value_type[
-                                value_type.find("'") + 1 : value_type.rfind("'")
-                            ]
-                            value_type = type_mapping[value_type]
-
-                            if value_type == rule7:
-                                result = "Fail"
-                            else:
-                                result = "Pass"
-                        else:
-                            result = "Check not required"
-
-                        results.append(
-                            {
-                                "Model Name": model_name,
-                                "Element Type": element_type,
-                                "Element ID": element_guid,
-                                "Attribute/ Property": prop,
-                                "Rule": "Data Type",
-                                "Result": result,
-                            }
-                        )
+        if not current_rules_df.empty:
+            table_rules[element_type] = (
+                table_id,
+                ifc_rules.index_rules(rules_df=current_rules_df),
+            )
 
-    result_df = pd.DataFrame(data=results)
+    if max_workers > 1:
+        checked_tables = iter_check_tables_in_parallel(
+            table_rules=table_rules,
+            value_list_index=value_list_index,
+            result_mode=result_mode,
+            incremental_validation=incremental_validation,
+            max_workers=max_workers,
+        )
+    else:
+        checked_tables = (
+            (
+                element_type,
+                check_table_rules(
+                    element_type=element_type,
+                    table_id=table_id,
+                    # compact rows share one schema of column names instead of one dict per row
+                    element_rows=mr.get_table_rows_compact(table_id=table_id),
+                    rules=rules,
+                    value_list_index=value_list_index,
+                    result_mode=result_mode,
+                    incremental_validation=incremental_validation,
+                ),
+            )
+            for element_type, (table_id, rules) in table_rules.items()
+        )
+
+    element_results = {}
+    for element_type, element_result_df in checked_tables:
+        if results_table_id:
+            pf.insert_chunks_into_table(
+                chunks=ifc_rules.iter_result_batches(
+                    result_df=element_result_df, batch_size=results_batch_size
+                ),
+                table_id=results_table_id,
+                insert_row_count=results_batch_size,
+            )
+        element_results[element_type] = element_result_df
+
+    # same order as the tables, whatever order they were checked in
+    results = [
+        element_results[element_type]
+        for element_type in table_rules
+        if element_type in element_results
+    ]
+    if len(results) == 0:
+        return pd.DataFrame()
+    result_df = pd.concat(results, ignore_index=True)
+    if result_mode == "categorical":
+        # categories differ between element types, concat gives back object columns
+        result_df = result_df.astype(
+            {
+                "Model Name": "category",
+                "Element Type": "category",
+                "Attribute/ Property": "category",
+            }
+        )
     return result_df
 
 
+def check_table_rules(
+    element_type: str,
+    table_id: str,
+    element_rows: list,
+    rules: dict,
+    value_list_index: ifc_rules.ValueListIndex,
+    result_mode: str = "full",
+    incremental_validation: ifc_rules.IncrementalValidation = None,
+) -> pd.DataFrame:
+    """
+    Checks the rules of one element type table, see check_rules
+    """
+    if incremental_validation:
+        return incremental_validation.check_element_rules(
+            element_type=element_type,
+            table_id=table_id,
+            element_rows=element_rows,
+            rules=rules,
+            value_list_index=value_list_index,
+            result_mode=result_mode,
+        )
+
+    values_df, present_df = ifc_rules.get_element_frame(element_rows=element_rows)
+    return ifc_rules.check_element_rules(
+        element_type=element_type,
+        values_df=values_df,
+        present_df=present_df,
+        rules=rules,
+        value_list_index=value_list_index,
+        result_mode=result_mode,
+    )
+
+
+def iter_check_tables_in_parallel(
+    table_rules: dict,
+    value_list_index: ifc_rules.ValueListIndex,
+    result_mode: str,
+    incremental_validation: ifc_rules.IncrementalValidation,
+    max_workers: int,
+) -> Iterator:
+    """
+    Purpose
+    -------
+    Checks the rules of element type tables in a pipeline:
+    - the rows of all the tables are fetched at the same time on a thread pool
+    - the rows of each table are checked on a process pool as soon as they arrive
+
+    so that the time taken is about the time of the largest table, not the sum of all tables
+
+    Input
+    -----
+    - table_rules: {element_type: (table_id, rules)}
+    - max_workers: number of threads fetching rows, and of processes checking rules
+
+    Output
+    ------
+    - yields (element_type, result_df) in the order the checks finish
+    """
+    # the check processes are started while the fetch threads hold locks (connection pools, ssl, ...):
+    # they are not forked from this process, which could copy a held lock and deadlock
+    can_forkserver = "forkserver" in multiprocessing.get_all_start_methods()
+    mp_context = multiprocessing.get_context("forkserver" if can_forkserver else "spawn")
+    with ThreadPoolExecutor(max_workers=max_workers) as fetch_executor:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as check_executor:
+            fetches = {}
+            for element_type, (table_id, rules) in table_rules.items():
+                # the morta client of the caller is used by the fetch threads too
+                fetch = fetch_executor.submit(
+                    contextvars.copy_context().run,
+                    mr.get_table_rows_compact,
+                    table_id=table_id,
+                )
+                fetches[fetch] = element_type
+
+            checks = {}
+            for fetch in as_completed(fetches):
+                element_type = fetches[fetch]
+                table_id, rules = table_rules[element_type]
+                check = check_executor.submit(
+                    check_table_rules,
+                    element_type=element_type,
+                    table_id=table_id,
+                    element_rows=fetch.result(),
+                    rules=rules,
+                    value_list_index=value_list_index,
+                    result_mode=result_mode,
+                    incremental_validation=incremental_validation,
+                )
+                checks[check] = element_type
+
+            for check in as_completed(checks):
+                yield checks[check], check.result()
+
+
 def get_header_data(ifc_file: ifcopenshell.file, model_name: str):
     full_name = ifc_file.wrapped_data.header.file_name.name
     file_name = full_name.split("/")[-1]
@@ -1146,8 +1413,28 @@ def get_type(ifc_obj) -> str:
     return ifc_obj.get_info()["type"]
 
 
+@functools.lru_cache(maxsize=None)
+def get_attribute_names(schema: str, ifc_class: str) -> tuple:
+    """
+    Purpose
+    -------
+    The attribute names of an ifc class from the ifcopenshell schema,
+    same as the keys of element.__dict__ (id, type, then the attributes)
+
+    Input
+    -----
+    - schema: ifc_file.schema, for example "IFC4"
+    - ifc_class: element.is_a(), for example "IfcWall"
+    """
+    declaration = ifcopenshell.ifcopenshell_wrapper.schema_by_name(
+        schema
+    ).declaration_by_name(ifc_class)
+    return ("id", "type") + tuple(
+        attribute.name() for attribute in declaration.all_attributes()
+    )
+
+
 def populate_rules_table(ifc_files: list, project_id: str, should_truncate: bool):
-    properties = []
     tables = ma.get_tables(project_id=project_id)
 
     for table in tables:
@@ -1165,23 +1452,25 @@ def populate_rules_table(ifc_files: list, project_id: str, should_truncate: bool
         elif table["name"] == "Ifc Checker Rules":
             table_id = table["publicId"]
 
+    # (element type, grouping, attribute/ property), deduplicated as they are found
+    properties = set()
     for ifc_file in ifc_files:
         for ifc_type in types:
             try:
                 elements = ifc_file.by_type(type=ifc_type)
             except Exception:
                 elements = []
+            # property sets and classes are shared by many elements, read each one once
+            seen_classes = set()
+            seen_definitions = set()
             for element in elements:
-                pset_name = "Attributes"
-                attributes = element.__dict__
-                for prop in list(attributes.keys()):
-                    properties.append(
-                        {
-                            "Element Type": ifc_type,
-                            "Grouping": pset_name,
-                            "Attribute/ Property": prop,
-                        }
-                    )
+                element_class = element.is_a()
+                if element_class not in seen_classes:
+                    seen_classes.add(element_class)
+                    for prop in get_attribute_names(
+                        schema=ifc_file.schema, ifc_class=element_class
+                    ):
+                        properties.add((ifc_type, "Attributes", prop))
 
                 definitions = (
                     element.IsDefinedBy
@@ -1198,77 +1487,30 @@ def populate_rules_table(ifc_files: list, project_id: str, should_truncate: bool
                 for definition in definitions:
                     if hasattr(definition, "RelatingPropertyDefinition"):
                         relating_prop = definition.RelatingPropertyDefinition
+                        if relating_prop.id() in seen_definitions:
+                            continue
+                        seen_definitions.add(relating_prop.id())
                         if hasattr(relating_prop, "Quantities"):
-                            quantities = relating_prop.Quantities
-                            for quantity in quantities:
-                                quantity_name = quantity.Name
-                                properties.append(
-                                    {
-                                        "Element Type": ifc_type,
-                                        "Grouping": relating_prop.Name,
-                                        "Attribute/ Property": quantity_name,
-                                    }
+                            for quantity in relating_prop.Quantities:
+                                properties.add(
+                                    (ifc_type, relating_prop.Name, quantity.Name)
                                 )
 
                         elif hasattr(relating_prop, "HasProperties"):
-                            props = relating_prop.HasProperties
-                            for prop in props:
-                                prop_name = prop.Name
-                                properties.append(
-                                    {
-                                        "Element Type": ifc_type,
-                                        "Grouping": relating_prop.Name,
-                                        "Attribute/ Property": prop_name,
-                                    }
-                                )
+                            for prop in relating_prop.HasProperties:
+                                properties.add((ifc_type, relating_prop.Name, prop.Name))
 
                     elif hasattr(definition, "RelatingType"):
-                        properties.append(
-                            {
-                                "Element Type": ifc_type,
-                                "Grouping": "RelatingType",
-                                "Attribute/ Property": "Element Type",
-                            }
-                        )
-                        properties.append(
-                            {
-                                "Element Type": ifc_type,
-                                "Grouping": "RelatingType",
-                                "Attribute/ Property": "Name",
-                            }
-                        )
-                        properties.append(
-                            {
-                                "Element Type": ifc_type,
-                                "Grouping": "RelatingType",
-                                "Attribute/ Property": "Description",
-                            }
-                        )
-                        properties.append(
-                            {
-                                "Element Type": ifc_type,
-                                "Grouping": "RelatingType",
-                                "Attribute/ Property": "GlobalId",
-                            }
-                        )
-                        properties.append(
-                            {
-                                "Element Type": ifc_type,
-                                "Grouping": "RelatingType",
-                                "Attribute/ Property": "PredefinedType",
-                            }
-                        )
+                        for prop in RELATING_TYPE_PROPERTIES:
+                            properties.add((ifc_type, "RelatingType", prop))
+
                     elif hasattr(definition, "HasProperties"):
-                        props = definition.HasProperties
-                        for prop in props:
-                            prop_name = prop.Name
-                            properties.append(
-                                {
-                                    "Element Type": ifc_type,
-                                    "Grouping": definition.Name,
-                                    "Attribute/ Property": prop_name,
-                                }
-                            )
+                        if definition.id() in seen_definitions:
+                            continue
+                        seen_definitions.add(definition.id())
+                        for prop in definition.HasProperties:
+                            properties.add((ifc_type, definition.Name, prop.Name))
+
                 associations = (
                     element.HasAssociations
                     if hasattr(element, "HasAssociations") and element.HasAssociations
@@ -1276,35 +1518,14 @@ def populate_rules_table(ifc_files: list, project_id: str, should_truncate: bool
                 )
 
                 for association in associations:
-                    association_type = str(association)
-                    association_type = association_type[
-                        association_type.find("=") + 1 : association_type.find("(")
-                    ]
-                    if association_type == "IfcRelAssociatesClassification":
-                        properties.append(
-                            {
-                                "Element Type": ifc_type,
-                                "Grouping": "Classification",
-                                "Attribute/ Property": "Name",
-                            }
-                        )
-                        properties.append(
-                            {
-                                "Element Type": ifc_type,
-                                "Grouping": "Classification",
-                                "Attribute/ Property": "ItemReference",
-                            }
-                        )
-                        properties.append(
-                            {
-                                "Element Type": ifc_type,
-                                "Grouping": "Classification",
-                                "Attribute/ Property": "ItemName",
-                            }
-                        )
+                    if association.is_a() == "IfcRelAssociatesClassification":
+                        for prop in CLASSIFICATION_PROPERTIES:
+                            properties.add((ifc_type, "Classification", prop))
 
-    df = pd.DataFrame(data=properties)
-    df = df.drop_duplicates()
+    df = pd.DataFrame(
+        data=list(properties),
+        columns=["Element Type", "Grouping", "Attribute/ Property"],
+    )
     df = df.sort_values(by=["Element Type", "Grouping", "Attribute/ Property"])
 
     df["Should Exist"] = True
@@ -1315,15 +1536,20 @@ def populate_rules_table(ifc_files: list, project_id: str, should_truncate: bool
     ] = True
 
     # create keys
-    df["Key"] = df.apply(
-        lambda row: " - ".join(
-            [row["Element Type"], row["Grouping"], row["Attribute/ Property"]]
-        ),
-        axis=1,
-    )
-    df["Property Key"] = df.apply(
-        lambda row: " - ".join([row["Grouping"], row["Attribute/ Property"]]), axis=1
-    )
+    df["Property Key"] = df["Grouping"] + " - " + df["Attribute/ Property"]
+    df["Key"] = df["Element Type"] + " - " + df["Property Key"]
+    df = df[
+        [
+            "Element Type",
+            "Grouping",
+            "Attribute/ Property",
+            "Should Exist",
+            "Should have value",
+            "Must be unique",
+            "Key",
+            "Property Key",
+        ]
+    ]
 
     rows = pf.dataframe_to_morta_rows(input_df=df)
 
@@ -1408,21 +1634,10 @@ def load_viewpoint_files(
         document_id = row_data["Document ID"]
         revision_id = row_data["Revision ID"]
 
-        # get file id
-        response = mva.get_revision(
-            document_id=document_id, revision_id=revision_id, api_key=api_key
-        )
-        file_id = response.json()["data"]["body"]["RevisionInfos"][0]["Files"][0]["ID"]
-
         # get ifc_file
-        response = mva.get_file(
-            document_id=document_id,
-            revision_id=revision_id,
-            file_id=file_id,
-            api_key=api_key,
+        ifc_file = get_viewpoint_file(
+            document_id=document_id, revision_id=revision_id, api_key=api_key
         )
-        ifc_text = response.text
-        ifc_file = ifcopenshell.file.from_string(ifc_text)
         ifc_files.append(ifc_file)
 
     if should_populate_rules:
@@ -1686,23 +1901,96 @@ def get_tables_mapping(project_id: str, table_names: list):
     return mapping
 
 
-def get_viewpoint_file(document_id: str, revision_id: str, api_key: str = None):
+def get_viewpoint_file(
+    document_id: str, revision_id: str, api_key: str = None, cache_directory: str = None
+):
+    # the file is streamed to disk and parsed from there, so its text is never held in memory
+    file_data = download_viewpoint_file(
+        document_id=document_id,
+        revision_id=revision_id,
+        api_key=api_key,
+        cache_directory=cache_directory,
+    )
+    try:
+        ifc_file = ifcopenshell.open(file_data["filePath"])
+    finally:
+        remove_viewpoint_file(file_data=file_data)
+    return ifc_file
+
+
+def download_viewpoint_file(
+    document_id: str, revision_id: str, api_key: str = None, cache_directory: str = None
+) -> dict:
+    """
+    Purpose
+    -------
+    Downloads the ifc file of a viewpoint document revision to disk
+
+    If cache_directory is given, files are kept there by the sha256 of their content, with an index
+    from document and revision to content. A revision already in the cache is not downloaded again.
+
+    Input
+    -----
+    - document_id, revision_id: viewpoint ids of the document revision
+    - cache_directory (optional): directory of the local file cache
+
+    Output
+    ------
+    - {"filePath": path, "contentHash": sha256 hex digest, "isCached": bool}
+        - remove the file with remove_viewpoint_file when done (cached files are kept)
+    """
+    if cache_directory:
+        index_path = os.path.join(cache_directory, "revisions", f"{document_id}_{revision_id}")
+        if os.path.exists(index_path):
+            with open(index_path, "r") as index_file:
+                content_hash = index_file.read().strip()
+            cached_path = os.path.join(cache_directory, "files", f"{content_hash}.ifc")
+            if os.path.exists(cached_path):
+                return {"filePath": cached_path, "contentHash": content_hash, "isCached": True}
+
     # get file id
     response = mva.get_revision(
         document_id=document_id, revision_id=revision_id, api_key=api_key
     )
     file_id = response.json()["data"]["body"]["RevisionInfos"][0]["Files"][0]["ID"]
 
-    # get ifc_file
-    response = mva.get_file(
-        document_id=document_id,
-        revision_id=revision_id,
-        file_id=file_id,
-        api_key=api_key,
-    )
-    ifc_text = response.text
-    ifc_file = ifcopenshell.file.from_string(ifc_text)
-    return ifc_file
+    # download to a temporary file, in the cache directory so it can be moved into the cache
+    path = None
+    try:
+        if cache_directory:
+            os.makedirs(os.path.join(cache_directory, "files"), exist_ok=True)
+            os.makedirs(os.path.join(cache_directory, "revisions"), exist_ok=True)
+            file_descriptor, path = tempfile.mkstemp(suffix=".ifc", dir=cache_directory)
+            os.close(file_descriptor)
+
+        path, content_hash = mva.download_file(
+            document_id=document_id,
+            revision_id=revision_id,
+            file_id=file_id,
+            path=path,
+            suffix=".ifc",
+            api_key=api_key,
+        )
+        if not cache_directory:
+            return {"filePath": path, "contentHash": content_hash, "isCached": False}
+
+        cached_path = os.path.join(cache_directory, "files", f"{content_hash}.ifc")
+        os.replace(path, cached_path)
+    except Exception:
+        # do not leave a partial file
+        if path and os.path.exists(path):
+            os.remove(path)
+        raise
+
+    with open(index_path, "w") as index_file:
+        index_file.write(content_hash)
+    return {"filePath": cached_path, "contentHash": content_hash, "isCached": True}
+
+
+def remove_viewpoint_file(file_data: dict):
+    # files in the cache are kept for the next runs
+    if not file_data["isCached"]:
+        os.remove(file_data["filePath"])
 
 
 def create_ifc_table(
@@ -1869,11 +2157,26 @@ def convert_to_int(value) -> int:
 def upload_document_to_viewpoint(
     document_id: str,
     document_name: str,
-    bytes_object: bytes,
-    user_name: str,
-    password: str,
+    bytes_object: bytes = None,
+    user_name: str = None,
+    password: str = None,
     api_key: str = None,
+    file_path: str = None,
 ):
+    """
+    Purpose
+    -------
+    Uploads a new revision of a viewpoint document
+
+    Input
+    -----
+    - bytes_object: the file content, or
+    - file_path: path of the file, streamed from disk (see ifc_file.write)
+
+    Output
+    ------
+    - url of the new revision
+    """
     # get token
     # ---------
     token = vp_api.get_token(
@@ -1902,6 +2205,7 @@ def upload_document_to_viewpoint(
         file_name=document_name,
         is_primary_file="true",
         bytes_object=bytes_object,
+        file_path=file_path,
         token=token,
     )
 
@@ -0,0 +1,258 @@
+"""
+Per-file indexes used to speed up the extraction of ifc elements
+
+The extraction helpers in functions.py look up the relationships of every element on its own.
+Elements share most of these relationships (the same few storeys, types, property sets and
+classification references), so the indexes here read each relationship once per file and
+keep the formatted results for the next elements.
+"""
+
+# packages
+import ifcopenshell
+import ifcopenshell.util.element
+import ifcopenshell.util.classification
+
+
+class SpatialIndex:
+    """
+    Purpose
+    -------
+    The spatial structure of one ifc file:
+    - element id -> spatial container, read once from IfcRelContainedInSpatialStructure
+    - spatial element id -> formatted container chain, computed the first time it is needed
+
+    Both formats used by the extraction are available:
+    - get_spatial_containers: {"BuildingStorey - Name": ..., "BuildingStorey - LongName": ...}
+    - get_structure_names: {"BuildingStorey": "Name - LongName"}
+
+    Input
+    -----
+    - ifc_file is the result of ifcopenshell.open function
+    """
+
+    def __init__(self, ifc_file: ifcopenshell.file):
+        self.ifc_file = ifc_file
+        self.containers = {}
+        self.indirect_containers = {}
+        self.spatial_containers = {}
+        self.structure_names = {}
+
+        for relationship in ifc_file.by_type("IfcRelContainedInSpatialStructure"):
+            relating_structure = relationship.RelatingStructure
+            for element in relationship.RelatedElements or ():
+                self.containers.setdefault(element.id(), relating_structure)
+
+    def get_container(self, element: ifcopenshell.entity_instance):
+        """
+        Same as ifcopenshell.util.element.get_container:
+        the direct container, otherwise the container of the parent
+        """
+        element_id = element.id()
+        container = self.containers.get(element_id)
+        if container is not None:
+            return container
+
+        if element_id not in self.indirect_containers:
+            parent = ifcopenshell.util.element.get_parent(element)
+            self.indirect_containers[element_id] = self.get_container(parent) if parent else None
+        return self.indirect_containers[element_id]
+
+    def get_spatial_containers(self, element: ifcopenshell.entity_instance, properties: list = ["Name", "LongName"]):
+        """
+        Same as functions.get_spatial_containers
+        """
+        container = self.get_container(element)
+        start = container if container else ifcopenshell.util.element.get_aggregate(element)
+        if not start:
+            return {}
+
+        key = (start.id(), tuple(properties))
+        if key not in self.spatial_containers:
+            self.spatial_containers[key] = format_spatial_containers(start=start, properties=properties)
+        return dict(self.spatial_containers[key])
+
+    def get_structure_names(self, element: ifcopenshell.entity_instance) -> dict:
+        """
+        Purpose
+        -------
+        The spatial structure of an element as written by functions.extract:
+        {"<Type without Ifc>": "Name - LongName"} for the container and the elements it decomposes
+
+        Elements which have no ContainedInStructure attribute start from the element they decompose.
+        """
+        if hasattr(element, "ContainedInStructure"):
+            start = self.containers.get(element.id())
+        elif hasattr(element, "Decomposes") and len(element.Decomposes) > 0:
+            start = element.Decomposes[0].RelatingObject
+        else:
+            start = None
+        if start is None:
+            return {}
+
+        start_id = start.id()
+        if start_id not in self.structure_names:
+            self.structure_names[start_id] = format_structure_names(start=start)
+        return dict(self.structure_names[start_id])
+
+
+def format_spatial_containers(start: ifcopenshell.entity_instance, properties: list) -> dict:
+    properties = list(reversed(properties))
+    result = {}
+    parent = start
+    while parent:
+        info = parent.get_info()
+        parent_type = info["type"].replace("Ifc", "")
+        for prop in properties:
+            if prop in info:
+                result[f"{parent_type} - {prop}"] = info[prop]
+
+        parent = ifcopenshell.util.element.get_aggregate(parent)
+
+    # reorder keys
+    return dict(reversed(list(result.items())))
+
+
+def format_structure_names(start: ifcopenshell.entity_instance) -> dict:
+    result = {}
+    relating_structure = start
+    while True:
+        relating_structure_type = relating_structure.is_a().replace("Ifc", "")
+        name_componenets = [relating_structure.Name if relating_structure.Name else ""]
+        if hasattr(relating_structure, "LongName"):
+            if relating_structure.LongName:
+                name_componenets.append(relating_structure.LongName)
+        result[relating_structure_type] = " - ".join(name_componenets)
+
+        if not hasattr(relating_structure, "Decomposes") or len(relating_structure.Decomposes) == 0:
+            return result
+        relating_structure = relating_structure.Decomposes[0].RelatingObject
+
+
+class RelationshipIndex:
+    """
+    Purpose
+    -------
+    The property sets, types and classification references of one ifc file, read in one pass over
+    IfcRelDefinesByProperties, IfcRelDefinesByType and IfcRelAssociatesClassification
+
+    - get_psets: same as ifcopenshell.util.element.get_psets(element, should_inherit=True)
+      the property sets of each type are flattened once and copied into its occurrences
+    - get_type: same as ifcopenshell.util.element.get_type
+    - get_references: same as ifcopenshell.util.classification.get_references
+    - get_info: element.get_info(), kept for the shared types and classification references
+
+    Input
+    -----
+    - ifc_file is the result of ifcopenshell.open function
+    """
+
+    def __init__(self, ifc_file: ifcopenshell.file):
+        self.ifc_file = ifc_file
+        self.definitions = {}
+        self.types = {}
+        self.references = {}
+        self.property_definitions = {}
+        self.type_psets = {}
+        self.type_references = {}
+        self.reference_systems = {}
+        self.infos = {}
+
+        for relationship in ifc_file.by_type("IfcRelDefinesByProperties"):
+            definition = relationship.RelatingPropertyDefinition
+            # IfcPropertySetDefinitionSet is a defined type wrapping a list of property set definitions
+            if definition.is_a("IfcPropertySetDefinitionSet"):
+                definitions = definition.wrappedValue
+            else:
+                definitions = (definition,)
+            for related_object in relationship.RelatedObjects or ():
+                self.definitions.setdefault(related_object.id(), []).extend(definitions)
+
+        for relationship in ifc_file.by_type("IfcRelDefinesByType"):
+            for related_object in relationship.RelatedObjects or ():
+                self.types.setdefault(related_object.id(), relationship.RelatingType)
+
+        for relationship in ifc_file.by_type("IfcRelAssociatesClassification"):
+            for related_object in relationship.RelatedObjects or ():
+                self.references.setdefault(related_object.id(), set()).add(relationship.RelatingClassification)
+
+    def get_type(self, element: ifcopenshell.entity_instance):
+        if element.is_a("IfcTypeObject"):
+            return element
+        return self.types.get(element.id())
+
+    def get_property_definition(self, definition: ifcopenshell.entity_instance) -> dict:
+        definition_id = definition.id()
+        if definition_id not in self.property_definitions:
+            self.property_definitions[definition_id] = ifcopenshell.util.element.get_property_definition(definition)
+        return self.property_definitions[definition_id]
+
+    def get_psets(self, element: ifcopenshell.entity_instance) -> dict:
+        if element.is_a("IfcTypeObject"):
+            type_psets = self.get_type_psets(element_type=element)
+            return {pset_name: dict(properties) for pset_name, properties in type_psets.items()}
+
+        # materials and profiles do not use the relationships indexed here
+        if not hasattr(element, "IsDefinedBy"):
+            return ifcopenshell.util.element.get_psets(element=element, should_inherit=True)
+
+        psets = {}
+        element_type = self.get_type(element)
+        if element_type:
+            type_psets = self.get_type_psets(element_type=element_type)
+            psets = {pset_name: dict(properties) for pset_name, properties in type_psets.items()}
+
+        for definition in self.definitions.get(element.id(), ()):
+            psets.setdefault(definition.Name, {}).update(self.get_property_definition(definition=definition))
+        return psets
+
+    def get_type_psets(self, element_type: ifcopenshell.entity_instance) -> dict:
+        type_id = element_type.id()
+        if type_id not in self.type_psets:
+            psets = {}
+            for definition in element_type.HasPropertySets or []:
+                psets.setdefault(definition.Name, {}).update(self.get_property_definition(definition=definition))
+            self.type_psets[type_id] = psets
+        return self.type_psets[type_id]
+
+    def get_references(self, element: ifcopenshell.entity_instance) -> set:
+        if not element.is_a("IfcRoot"):
+            return ifcopenshell.util.classification.get_references(element=element)
+
+        occurrence_references = self.references.get(element.id(), set())
+        results = set()
+        if element.is_a("IfcObject"):
+            element_type = self.get_type(element)
+            if element_type and element_type != element:
+                type_id = element_type.id()
+                if type_id not in self.type_references:
+                    self.type_references[type_id] = self.get_references(element=element_type)
+                results = self.type_references[type_id]
+
+        if not results:
+            return set(occurrence_references)
+
+        # occurrence references override the type references of the same classification system
+        type_references_per_system = {}
+        occurrence_references_per_system = {}
+        for reference in results:
+            type_references_per_system.setdefault(self.get_reference_system(reference), []).append(reference)
+        for reference in occurrence_references:
+            occurrence_references_per_system.setdefault(self.get_reference_system(reference), []).append(reference)
+        type_references_per_system.update(occurrence_references_per_system)
+        return {reference for references in type_references_per_system.values() for reference in references}
+
+    def get_reference_system(self, reference: ifcopenshell.entity_instance):
+        reference_id = reference.id()
+        if reference_id not in self.reference_systems:
+            self.reference_systems[reference_id] = ifcopenshell.util.classification.get_classification(reference)
+        return self.reference_systems[reference_id]
+
+    def get_info(self, element: ifcopenshell.entity_instance, recursive: bool = False) -> dict:
+        """
+        element.get_info(recursive=recursive), computed once per element.
+        The result is shared, do not modify it.
+        """
+        key = (element.id(), recursive)
+        if key not in self.infos:
+            self.infos[key] = element.get_info(recursive=recursive)
+        return self.infos[key]
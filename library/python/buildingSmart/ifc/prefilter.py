@@ -0,0 +1,281 @@
+"""
+Reducing an ifc file to the elements which are extracted, before ifcopenshell parses it
+
+Most of a model is geometry, which the extraction never reads. prefilter_ifc_file streams the DATA
+section of the STEP file and writes a smaller ifc file with only:
+- the elements of the requested types (and their subtypes)
+- their property sets, quantities, types and classification references
+- their spatial structure up to the IfcProject (containers, aggregates, nests, openings)
+- everything these instances reference, except the placements and representations of the products
+
+The instances keep their ids, and the relationships only keep the objects which are in the reduced file,
+so extracting the reduced file gives the same rows as extracting the original one.
+"""
+
+# packages
+import os
+import array
+import functools
+import tempfile
+import ifcopenshell
+import ifcopenshell.ifcopenshell_wrapper
+
+# from repo
+import library.python.buildingSmart.ifc.functions as ifc_functions
+import library.python.buildingSmart.ifc.step as ifc_step
+
+# relationships read by the spatial index of the extraction, from an element to its parent:
+# {entity name: (attribute with the children, attribute with the parent)}
+PARENT_RELATIONSHIPS = {
+    "IFCRELCONTAINEDINSPATIALSTRUCTURE": ("RelatedElements", "RelatingStructure"),
+    "IFCRELAGGREGATES": ("RelatedObjects", "RelatingObject"),
+    "IFCRELNESTS": ("RelatedObjects", "RelatingObject"),
+    "IFCRELFILLSELEMENT": ("RelatedBuildingElement", "RelatingOpeningElement"),
+    "IFCRELVOIDSELEMENT": ("RelatedOpeningElement", "RelatingBuildingElement"),
+    "IFCRELADHERESTOELEMENT": ("RelatedSurfaceFeatures", "RelatingElement"),
+}
+
+# relationships read by the relationship index of the extraction, from an element to its definitions
+DEFINITION_RELATIONSHIPS = {
+    "IFCRELDEFINESBYPROPERTIES": ("RelatedObjects", "RelatingPropertyDefinition"),
+    "IFCRELDEFINESBYTYPE": ("RelatedObjects", "RelatingType"),
+    "IFCRELASSOCIATESCLASSIFICATION": ("RelatedObjects", "RelatingClassification"),
+}
+
+# instances kept even when no element references them: units and header data
+ROOT_ENTITIES = ["IFCPROJECT", "IFCAPPLICATION"]
+
+# attributes emptied in the reduced file: geometry is not extracted
+# {supertype: [attribute names]}, the attributes are optional in all schemas
+STRIPPED_ATTRIBUTES = {
+    "IfcProduct": ["ObjectPlacement", "Representation"],
+    "IfcTypeProduct": ["RepresentationMaps"],
+}
+
+# files smaller than this are opened directly, the extra read of the file costs more than it saves
+PREFILTER_MIN_FILE_SIZE = 50 * 1024 * 1024
+
+
+def prefilter_ifc_file(file_path: str, ifc_types: list, output_path: str) -> dict:
+    """
+    Purpose
+    -------
+    Writes a reduced copy of an ifc file, with only what is needed to extract ifc_types
+
+    The file is read once from start to end, keeping the position of each instance and the relationships.
+    The instances of the reduced file are then read from their positions, so the rest of the work
+    depends on the size of the reduced file and not on the size of the model.
+
+    Input
+    -----
+    - file_path: path of the ifc file
+    - ifc_types: list of str. ifc types examples: IfcDoor, IfcWindow, etc.
+    - output_path: path of the reduced ifc file
+
+    Output
+    ------
+    - {"instanceCount": number of instances in the file, "keptCount": number of instances written}
+    """
+    requested_types = tuple(ifc_functions.get_unique_ifc_types(ifc_types=ifc_types))
+    with open(file_path, "rb") as stream:
+        header_bytes, buffer = ifc_step.read_header_bytes(stream=stream)
+        schema_identifiers = ifc_step.parse_header(header_text=ifc_step.decode_bytes(data=header_bytes)).get(
+            "schema_identifiers"
+        )
+        if not schema_identifiers:
+            raise Exception(f"Could not read the schema of the ifc file: {file_path}")
+        schema = schema_identifiers[0]
+
+        # first pass: positions of the instances, requested elements and relationships
+        offsets = array.array("q")
+        elements = set()
+        roots = set()
+        parents = {}
+        relationships = {}
+        instance_count = 0
+        for instance_id, entity_name, parameters, offset in ifc_step.iter_raw_instances(
+            stream=stream, buffer=buffer, offset=stream.tell() - len(buffer)
+        ):
+            instance_count = instance_count + 1
+            if instance_id >= len(offsets):
+                offsets.extend([-1] * max(instance_id + 1 - len(offsets), len(offsets)))
+            offsets[instance_id] = offset
+
+            if is_requested(schema=schema, entity_name=entity_name, requested_types=requested_types):
+                elements.add(instance_id)
+            elif entity_name in ROOT_ENTITIES:
+                roots.add(instance_id)
+            elif entity_name in PARENT_RELATIONSHIPS or entity_name in DEFINITION_RELATIONSHIPS:
+                children, parent = read_relationship(schema=schema, entity_name=entity_name, parameters=parameters)
+                relationships[instance_id] = (entity_name, children, parent)
+                if entity_name in PARENT_RELATIONSHIPS:
+                    for child in children:
+                        parents.setdefault(child, []).append(instance_id)
+
+        kept_objects, kept_relationships = select_objects(
+            elements=elements, parents=parents, relationships=relationships
+        )
+        del parents, relationships
+
+        # everything the kept instances reference
+        kept_instances = {}
+        queue = list(kept_objects | kept_relationships | roots)
+        queued_ids = set(queue)
+        while queue:
+            instance_id = queue.pop()
+            if instance_id >= len(offsets) or offsets[instance_id] == -1:
+                # reference to an instance which is not in the file
+                continue
+            _, entity_name, parameters = ifc_step.read_raw_instance(stream=stream, offset=offsets[instance_id])
+            parameters = reduce_parameters(
+                schema=schema, entity_name=entity_name, parameters=parameters, kept_objects=kept_objects
+            )
+            kept_instances[instance_id] = (entity_name, parameters)
+            for reference in ifc_step.get_references(parameters=parameters):
+                if reference not in queued_ids:
+                    queued_ids.add(reference)
+                    queue.append(reference)
+
+    # write the kept instances, in the order of the file
+    with open(output_path, "wb") as output:
+        output.write(b"ISO-10303-21;\nHEADER;" + header_bytes + b"ENDSEC;\nDATA;\n")
+        for instance_id in sorted(kept_instances, key=lambda instance_id: offsets[instance_id]):
+            entity_name, parameters = kept_instances[instance_id]
+            output.write(b"#%d=%s%s;\n" % (instance_id, entity_name.encode("ascii"), parameters))
+        output.write(b"ENDSEC;\nEND-ISO-10303-21;\n")
+
+    print(f"prefiltered ifc file: {file_path}, kept {str(len(kept_instances))} of {str(instance_count)} instances")
+    return {"instanceCount": instance_count, "keptCount": len(kept_instances)}
+
+
+def open_ifc_file(file_path: str, ifc_types: list) -> ifcopenshell.file:
+    """
+    Purpose
+    -------
+    Opens an ifc file for the extraction of ifc_types:
+    large files are prefiltered (see prefilter_ifc_file) into a temporary file which is opened instead
+    """
+    if os.path.getsize(file_path) < PREFILTER_MIN_FILE_SIZE:
+        return ifcopenshell.open(file_path)
+
+    file_descriptor, reduced_path = tempfile.mkstemp(suffix=".ifc")
+    os.close(file_descriptor)
+    try:
+        prefilter_ifc_file(file_path=file_path, ifc_types=ifc_types, output_path=reduced_path)
+        return ifcopenshell.open(reduced_path)
+    finally:
+        os.remove(reduced_path)
+
+
+def select_objects(elements: set, parents: dict, relationships: dict) -> tuple:
+    """
+    Purpose
+    -------
+    Finds the objects and relationships the extraction of elements reads:
+    - the types of the elements
+    - the parents of the elements, their parents, etc.
+    - the property sets, types and classifications of the elements and types
+
+    Output
+    ------
+    - (ids of the objects, ids of the relationships)
+    """
+    kept_relationships = set()
+
+    # types
+    kept_objects = set(elements)
+    for relationship_id, (entity_name, children, parent) in relationships.items():
+        if entity_name == "IFCRELDEFINESBYTYPE" and not elements.isdisjoint(children):
+            kept_objects.add(parent)
+
+    # definitions of the elements and types
+    for relationship_id, (entity_name, children, parent) in relationships.items():
+        if entity_name in DEFINITION_RELATIONSHIPS and not kept_objects.isdisjoint(children):
+            kept_relationships.add(relationship_id)
+
+    # spatial structure
+    queue = list(elements)
+    while queue:
+        child = queue.pop()
+        for relationship_id in parents.get(child, ()):
+            kept_relationships.add(relationship_id)
+            parent = relationships[relationship_id][2]
+            if parent is not None and parent not in kept_objects:
+                kept_objects.add(parent)
+                queue.append(parent)
+
+    return kept_objects, kept_relationships
+
+
+def read_relationship(schema: str, entity_name: str, parameters: bytes) -> tuple:
+    """
+    Output
+    ------
+    - (ids of the children, id of the parent or None)
+    """
+    children_index, parent_index = get_relationship_indexes(schema=schema, entity_name=entity_name)
+    values = ifc_step.split_parameters(parameters=parameters)
+    children = ifc_step.get_references(parameters=values[children_index])
+    parent = ifc_step.get_references(parameters=values[parent_index])
+    return children, (parent[0] if parent else None)
+
+
+def reduce_parameters(schema: str, entity_name: str, parameters: bytes, kept_objects: set) -> bytes:
+    """
+    Purpose
+    -------
+    The parameters of an instance as they are written in the reduced file:
+    - placements and representations of products are emptied
+    - the children of relationships are only the objects kept in the reduced file
+    """
+    stripped_indexes = get_stripped_indexes(schema=schema, entity_name=entity_name)
+    is_relationship = entity_name in PARENT_RELATIONSHIPS or entity_name in DEFINITION_RELATIONSHIPS
+    if not stripped_indexes and not is_relationship:
+        return parameters
+
+    values = ifc_step.split_parameters(parameters=parameters)
+    for index in stripped_indexes:
+        values[index] = b"$"
+    if is_relationship:
+        children_index, _ = get_relationship_indexes(schema=schema, entity_name=entity_name)
+        children = ifc_step.get_references(parameters=values[children_index])
+        kept_children = [b"#%d" % child for child in children if child in kept_objects]
+        if values[children_index].startswith(b"("):
+            values[children_index] = b"(" + b",".join(kept_children) + b")"
+    return b"(" + b",".join(values) + b")"
+
+
+@functools.lru_cache(maxsize=None)
+def is_requested(schema: str, entity_name: str, requested_types: tuple) -> bool:
+    return any(
+        ifc_functions.is_subtype(schema=schema, ifc_type=entity_name, super_type=requested_type)
+        for requested_type in requested_types
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_attribute_names(schema: str, entity_name: str) -> list:
+    declaration = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema).declaration_by_name(entity_name)
+    return [attribute.name() for attribute in declaration.all_attributes()]
+
+
+@functools.lru_cache(maxsize=None)
+def get_relationship_indexes(schema: str, entity_name: str) -> tuple:
+    children_attribute, parent_attribute = {**PARENT_RELATIONSHIPS, **DEFINITION_RELATIONSHIPS}[entity_name]
+    attribute_names = get_attribute_names(schema=schema, entity_name=entity_name)
+    return attribute_names.index(children_attribute), attribute_names.index(parent_attribute)
+
+
+@functools.lru_cache(maxsize=None)
+def get_stripped_indexes(schema: str, entity_name: str) -> list:
+    try:
+        attribute_names = get_attribute_names(schema=schema, entity_name=entity_name)
+    except Exception:
+        return []
+    return [
+        attribute_names.index(attribute_name)
+        for super_type, stripped_attributes in STRIPPED_ATTRIBUTES.items()
+        if ifc_functions.is_subtype(schema=schema, ifc_type=entity_name, super_type=super_type)
+        for attribute_name in stripped_attributes
+        if attribute_name in attribute_names
+    ]
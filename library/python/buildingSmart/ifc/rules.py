@@ -0,0 +1,627 @@
+"""
+Vectorized checks of the rules table against the rows of the element type tables
+
+functions.check_rules used to walk every element, every property and every rule row, and rebuilt the
+list of all the values of a property for every element to check uniqueness. Here the rows of a table
+become one dataframe and each rule is checked on a whole column at once:
+- rules are indexed by (Grouping, Attribute/ Property)
+- uniqueness uses duplicated within each Model Name
+- regex expressions are compiled once and matched once per distinct value
+- the Value List table is indexed once by (Element Type, Name), see ValueListIndex
+- existence and value checks are column masks
+
+The results are the same rows as the element by element checks, ordered by element, then by column
+(in the order the columns first appear in the rows), then by rule. The element by element checks
+followed the key order of each row, so the order differs when rows list their keys in different orders.
+"""
+
+# packages
+import os
+import json
+import numpy
+import pickle
+import hashlib
+import tempfile
+import functools
+import regex as re
+import pandas as pd
+
+# names of the rules in the results. "Must by unique" is kept as is, existing result tables use it
+RULE_NAMES = [
+    "Should Exist",
+    "Should have value",
+    "Must by unique",
+    "Value Regex Expression",
+    "Should be one of the below",
+    "Should not be one of below",
+    "Data Type",
+]
+UNIQUE_RULE_NAME = "Must by unique"
+# a rule row which checks nothing
+NO_RULES = {
+    "Should Exist": False,
+    "Should have value": False,
+    "Must be unique": False,
+    "Value Regex Expression": "",
+    "Should be one of the below": False,
+    "Should not be one of below": False,
+    "Data Type": "",
+}
+RESULTS = ["Pass", "Fail", "Check not required"]
+RESULT_COLUMNS = ["Model Name", "Element Type", "Element ID", "Attribute/ Property", "Rule", "Result"]
+SUMMARY_COLUMNS = ["Model Name", "Element Type", "Attribute/ Property", "Rule"] + RESULTS
+RESULT_MODES = ["full", "failures", "summary", "categorical"]
+
+# columns of the element type tables which are not checked
+IGNORED_COLUMNS = ["Model Name", "Project", "Building", "BuildingStorey", "Site", "Space", "Changed?"]
+
+TYPE_MAPPING = {
+    str: "text",
+    int: "integer",
+    float: "decimal",
+    bool: "boolean",
+    list: "list",
+}
+
+NOT_FOUND = "Not Found"
+CHECK_NOT_REQUIRED = "Check not required"
+PASS_FAIL = numpy.array(["Fail", "Pass"], dtype=object)
+
+
+def index_rules(rules_df: pd.DataFrame) -> dict:
+    """
+    Purpose
+    -------
+    Indexes the rules of one element type
+
+    Input
+    -----
+    - rules_df: rows of the rules table for one element type, without duplicated (Grouping, Attribute/ Property)
+
+    Output
+    ------
+    - {(grouping, attribute or property): rule row}
+    """
+    rules = {}
+    for rule in rules_df.to_dict(orient="records"):
+        rules.setdefault((rule["Grouping"], rule["Attribute/ Property"]), rule)
+    return rules
+
+
+def get_element_frame(element_rows: list) -> tuple:
+    """
+    Purpose
+    -------
+    Converts the rows of an element type table to columns
+
+    Input
+    -----
+    - element_rows: [{"publicId": ..., "rowData": {...}}], from get_table_rows or morta/rows.get_table_rows_compact
+
+    Output
+    ------
+    - (values_df, present_df), indexed by the publicId of the rows
+        - values_df: the cell values, as object columns so that lists and mixed types are kept as they are
+        - present_df: True where the row has the column at all. Rows without a column are not checked for it
+    """
+    row_count = len(element_rows)
+    columns = {}
+    present = {}
+    for row_index, row in enumerate(element_rows):
+        for column_name, value in row["rowData"].items():
+            if column_name not in columns:
+                columns[column_name] = [None] * row_count
+                present[column_name] = numpy.zeros(row_count, dtype=bool)
+            columns[column_name][row_index] = value
+            present[column_name][row_index] = True
+
+    index = pd.Index([row["publicId"] for row in element_rows], dtype=object)
+    values_df = pd.DataFrame(
+        data={column_name: pd.Series(values, index=index, dtype=object) for column_name, values in columns.items()},
+        index=index,
+    )
+    present_df = pd.DataFrame(data=present, index=index)
+    return values_df, present_df
+
+
+def check_element_rules(
+    element_type: str,
+    values_df: pd.DataFrame,
+    present_df: pd.DataFrame,
+    rules: dict,
+    value_list_index: "ValueListIndex",
+    result_mode: str = "full",
+    row_id_column: str = None,
+) -> pd.DataFrame:
+    """
+    Purpose
+    -------
+    Checks the rules of one element type against the rows of its table
+
+    Input
+    -----
+    - element_type: name of the element type table
+    - values_df, present_df: from get_element_frame
+    - rules: from index_rules
+    - value_list_index: ValueListIndex of the Value List table
+    - result_mode: one of RESULT_MODES
+        - "full": one row per element, checked property and rule
+        - "failures": only the rows with a "Fail" result
+        - "summary": one row per model, property and rule with the number of each result, see summarize_results
+        - "categorical": same rows as "full", with category columns
+    - row_id_column: optional column to add with the publicId of the row of each result
+
+    Output
+    ------
+    - dataframe with RESULT_COLUMNS, or SUMMARY_COLUMNS for "summary"
+    """
+    if result_mode not in RESULT_MODES:
+        raise Exception(f"Unknown result mode: {result_mode}, should be one of {RESULT_MODES}")
+
+    row_count = len(values_df.index)
+    model_names = get_column(values_df=values_df, column_name="Model Name")
+    element_ids = get_column(values_df=values_df, column_name="Attributes - GlobalId")
+    column_names = list(values_df.columns.values)
+
+    row_indexes = []
+    column_indexes = []
+    rule_indexes = []
+    results = []
+    for column_index, column_name in enumerate(column_names):
+        if column_name in IGNORED_COLUMNS:
+            continue
+        name_parts = column_name.split(" - ")
+        if len(name_parts) < 2:
+            continue
+        rule = rules.get((name_parts[0], name_parts[1]))
+        if rule is None:
+            continue
+
+        rows = numpy.flatnonzero(present_df[column_name].to_numpy())
+        if len(rows) == 0:
+            continue
+        values = values_df[column_name].iloc[rows]
+        rule_results = check_rule(
+            rule=rule,
+            values=values,
+            model_names=model_names.iloc[rows],
+            element_type=element_type,
+            value_list_index=value_list_index,
+        )
+        for rule_index, result in enumerate(rule_results):
+            row_indexes.append(rows)
+            column_indexes.append(numpy.full(len(rows), column_index))
+            rule_indexes.append(numpy.full(len(rows), rule_index))
+            results.append(result)
+
+    if len(results) == 0:
+        if result_mode == "summary":
+            return pd.DataFrame(columns=SUMMARY_COLUMNS)
+        return pd.DataFrame(columns=RESULT_COLUMNS + ([row_id_column] if row_id_column else []))
+
+    row_indexes = numpy.concatenate(row_indexes)
+    column_indexes = numpy.concatenate(column_indexes)
+    rule_indexes = numpy.concatenate(rule_indexes)
+    results = numpy.concatenate(results)
+    if result_mode == "failures":
+        failed = results == "Fail"
+        row_indexes = row_indexes[failed]
+        column_indexes = column_indexes[failed]
+        rule_indexes = rule_indexes[failed]
+        results = results[failed]
+
+    # element by element, then property by property, then rule by rule
+    order = numpy.lexsort((rule_indexes, column_indexes, row_indexes))
+    row_indexes = row_indexes[order]
+    column_indexes = column_indexes[order]
+    rule_indexes = rule_indexes[order]
+    results = results[order]
+
+    if result_mode == "categorical":
+        data = {
+            "Model Name": pd.Categorical(model_names.to_numpy()[row_indexes]),
+            "Element Type": pd.Categorical.from_codes(
+                codes=numpy.zeros(len(order), dtype=int), categories=[element_type]
+            ),
+            "Element ID": element_ids.to_numpy()[row_indexes],
+            "Attribute/ Property": pd.Categorical.from_codes(codes=column_indexes, categories=column_names),
+            "Rule": pd.Categorical.from_codes(codes=rule_indexes, categories=RULE_NAMES),
+            "Result": pd.Categorical(results, categories=RESULTS),
+        }
+    else:
+        data = {
+            "Model Name": model_names.to_numpy()[row_indexes],
+            "Element Type": numpy.full(len(order), element_type, dtype=object),
+            "Element ID": element_ids.to_numpy()[row_indexes],
+            "Attribute/ Property": numpy.array(column_names, dtype=object)[column_indexes],
+            "Rule": numpy.array(RULE_NAMES, dtype=object)[rule_indexes],
+            "Result": results,
+        }
+    if row_id_column:
+        data[row_id_column] = values_df.index.to_numpy()[row_indexes]
+    result_df = pd.DataFrame(data=data, index=pd.RangeIndex(len(order)))
+    print(f"checked rules of {element_type}: {str(row_count)} elements, {str(len(result_df.index))} results")
+
+    if result_mode == "summary":
+        return summarize_results(result_df=result_df)
+    return result_df
+
+
+def summarize_results(result_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Purpose
+    -------
+    Counts the results of each rule
+
+    Input
+    -----
+    - result_df: dataframe with RESULT_COLUMNS
+
+    Output
+    ------
+    - dataframe with SUMMARY_COLUMNS: one row per model name, element type, property and rule,
+      with the number of elements for each result
+    """
+    group_columns = ["Model Name", "Element Type", "Attribute/ Property", "Rule"]
+    summary_df = (
+        result_df.groupby(by=group_columns + ["Result"], sort=False, observed=True, dropna=False)
+        .size()
+        .unstack(level="Result", fill_value=0)
+        .reindex(columns=RESULTS, fill_value=0)
+        .reset_index()
+    )
+    summary_df.columns.name = None
+    return summary_df
+
+
+def apply_result_mode(result_df: pd.DataFrame, result_mode: str) -> pd.DataFrame:
+    """
+    Converts full results (see check_element_rules) to another result mode
+    """
+    if result_mode not in RESULT_MODES:
+        raise Exception(f"Unknown result mode: {result_mode}, should be one of {RESULT_MODES}")
+    if result_mode == "failures":
+        return result_df.loc[result_df["Result"] == "Fail"].reset_index(drop=True)
+    if result_mode == "summary":
+        return summarize_results(result_df=result_df)
+    if result_mode == "categorical":
+        return result_df.astype(
+            {column_name: "category" for column_name in RESULT_COLUMNS if column_name != "Element ID"}
+        )
+    return result_df
+
+
+def iter_result_batches(result_df: pd.DataFrame, batch_size: int):
+    for start in range(0, len(result_df.index), batch_size):
+        yield result_df.iloc[start : start + batch_size]
+
+
+def get_column(values_df: pd.DataFrame, column_name: str) -> pd.Series:
+    if column_name in values_df.columns:
+        return values_df[column_name]
+    return pd.Series([None] * len(values_df.index), index=values_df.index, dtype=object)
+
+
+def check_rule(
+    rule: dict, values: pd.Series, model_names: pd.Series, element_type: str, value_list_index: "ValueListIndex"
+) -> list:
+    """
+    Purpose
+    -------
+    Checks one rule row against the values of one column
+
+    Output
+    ------
+    - list of 7 arrays of "Pass", "Fail" or "Check not required", in the order of RULE_NAMES
+    """
+    length = len(values.index)
+    not_found = values.eq(NOT_FOUND).to_numpy()
+    has_value = values.astype(bool).to_numpy() & ~not_found
+
+    results = []
+    results.append(get_results(is_required=rule["Should Exist"], length=length, passed=~not_found))
+    results.append(get_results(is_required=rule["Should have value"], length=length, passed=has_value))
+
+    if rule["Must be unique"]:
+        duplicated = pd.DataFrame(
+            data={"Model Name": model_names.map(make_hashable), "value": values.map(make_hashable)}
+        ).duplicated(keep=False)
+        results.append(get_results(is_required=True, length=length, passed=~duplicated.to_numpy()))
+    else:
+        results.append(get_results(is_required=False, length=length))
+
+    expression = rule["Value Regex Expression"]
+    if isinstance(expression, str) and len(expression) > 0:
+        # values without a value are not checked
+        checked = values.astype(bool).to_numpy()
+        result = numpy.full(length, CHECK_NOT_REQUIRED, dtype=object)
+        result[checked] = PASS_FAIL[match_expression(expression=expression, values=values[checked]).astype(int)]
+        results.append(result)
+    else:
+        results.append(get_results(is_required=False, length=length))
+
+    listed = None
+    if rule["Should be one of the below"] or rule["Should not be one of below"]:
+        listed = value_list_index.is_listed(element_type=element_type, values=values)
+    results.append(get_results(is_required=rule["Should be one of the below"], length=length, passed=listed))
+    results.append(
+        get_results(
+            is_required=rule["Should not be one of below"], length=length, passed=None if listed is None else ~listed
+        )
+    )
+
+    data_type = rule["Data Type"]
+    if data_type:
+        # a value of the data type of the rule fails, as in the element by element checks
+        value_types = values.map(lambda value: TYPE_MAPPING.get(type(value)))
+        results.append(get_results(is_required=True, length=length, passed=value_types.ne(data_type).to_numpy()))
+    else:
+        results.append(get_results(is_required=False, length=length))
+
+    return results
+
+
+def get_results(is_required, length: int, passed: numpy.ndarray = None) -> numpy.ndarray:
+    if not is_required:
+        return numpy.full(length, CHECK_NOT_REQUIRED, dtype=object)
+    return PASS_FAIL[passed.astype(int)]
+
+
+def match_expression(expression: str, values: pd.Series) -> numpy.ndarray:
+    """
+    Matches a regex expression against each distinct value once. Values which are not text are matched as text.
+    """
+    pattern = compile_expression(expression=expression)
+    texts = values.map(str)
+    matches = {text: pattern.match(text) is not None for text in texts.unique()}
+    return texts.map(matches).to_numpy(dtype=bool)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_expression(expression: str):
+    return re.compile(expression)
+
+
+class ValueListIndex:
+    """
+    Purpose
+    -------
+    The Value List table, indexed once per run for the "Should be one of the below" and
+    "Should not be one of below" rules: (Element Type, Name) -> frozenset of Value
+
+    A value is listed if a row of its element type has it as Name and as Value.
+    The result for each distinct value is kept for the next columns and tables.
+
+    Input
+    -----
+    - value_list_rows: rows of the Value List table
+    """
+
+    def __init__(self, value_list_rows: list):
+        values = {}
+        for row in value_list_rows:
+            row_data = row["rowData"]
+            key = (row_data.get("Element Type"), make_hashable(value=row_data.get("Name")))
+            values.setdefault(key, set()).add(make_hashable(value=row_data.get("Value")))
+        self.values = {key: frozenset(key_values) for key, key_values in values.items()}
+        self.results = {}
+        # changes whenever the Value List table changes, see IncrementalValidation
+        self.hash = get_hash(data=sorted(get_hash(data=dict(row["rowData"])) for row in value_list_rows))
+
+    def is_value_listed(self, element_type: str, value) -> bool:
+        key = (element_type, value)
+        result = self.results.get(key)
+        if result is None:
+            result = value in self.values.get(key, ())
+            self.results[key] = result
+        return result
+
+    def is_listed(self, element_type: str, values: pd.Series) -> numpy.ndarray:
+        """
+        Checks each distinct value once
+        """
+        codes, unique_values = pd.factorize(values.map(make_hashable), use_na_sentinel=False)
+        listed = numpy.array(
+            [self.is_value_listed(element_type=element_type, value=value) for value in unique_values], dtype=bool
+        )
+        return listed[codes]
+
+
+def make_hashable(value):
+    # lists and dicts from Morta cells, so that they can be compared by duplicated
+    if isinstance(value, list):
+        return tuple(make_hashable(value=item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, make_hashable(value=item)) for key, item in value.items()))
+    return value
+
+
+def get_hash(data) -> str:
+    text = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class IncrementalValidation:
+    """
+    Purpose
+    -------
+    Keeps the results of the last check of each element type table, so that the next check
+    only checks the rows which changed since (for example the rows edited through the "Changed?" flow):
+    - rows are compared by the hash of their cells
+    - the rules of the table and the Value List table are hashed too, any change checks every row again
+    - uniqueness is checked again for all the rows of the Model Names of the changed and removed rows
+
+    The state of each table is a pickle file in the directory.
+
+    Input
+    -----
+    - directory: created if it does not exist
+    """
+
+    ROW_ID_COLUMN = "Row Id"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, table_id: str) -> str:
+        return os.path.join(self.directory, f"{table_id}.pickle")
+
+    def load(self, table_id: str):
+        try:
+            with open(self.get_path(table_id=table_id), "rb") as file:
+                return pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save(self, table_id: str, state: dict):
+        # write to a temporary file first, so that a failed run never leaves a partly written state
+        file_descriptor, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.get_path(table_id=table_id))
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def check_element_rules(
+        self,
+        element_type: str,
+        table_id: str,
+        element_rows: list,
+        rules: dict,
+        value_list_index: ValueListIndex,
+        result_mode: str = "full",
+    ) -> pd.DataFrame:
+        """
+        Purpose
+        -------
+        Same as check_element_rules, but only checks the rows which changed since the last check of the table
+
+        Input
+        -----
+        - element_type, rules, value_list_index, result_mode: see check_element_rules
+        - table_id: element type table the rows come from
+        - element_rows: all the rows of the table, from get_table_rows or morta/rows.get_table_rows_compact
+        """
+        values_df, present_df = get_element_frame(element_rows=element_rows)
+        row_hashes = {row["publicId"]: get_hash(data=dict(row["rowData"])) for row in element_rows}
+        model_names = get_column(values_df=values_df, column_name="Model Name").map(make_hashable)
+        rules_hash = get_hash(data=[sorted(rules.items(), key=str), value_list_index.hash])
+
+        state = self.load(table_id=table_id)
+        if state is None or state["rulesHash"] != rules_hash:
+            result_df = check_element_rules(
+                element_type=element_type,
+                values_df=values_df,
+                present_df=present_df,
+                rules=rules,
+                value_list_index=value_list_index,
+                row_id_column=self.ROW_ID_COLUMN,
+            )
+        else:
+            result_df = self.check_changed_rows(
+                element_type=element_type,
+                values_df=values_df,
+                present_df=present_df,
+                rules=rules,
+                value_list_index=value_list_index,
+                row_hashes=row_hashes,
+                model_names=model_names,
+                state=state,
+            )
+
+        self.save(
+            table_id=table_id,
+            state={
+                "rulesHash": rules_hash,
+                "rowHashes": row_hashes,
+                "modelNames": model_names.to_dict(),
+                "resultDf": result_df,
+            },
+        )
+        return apply_result_mode(result_df=result_df.drop(columns=[self.ROW_ID_COLUMN]), result_mode=result_mode)
+
+    def check_changed_rows(
+        self,
+        element_type: str,
+        values_df: pd.DataFrame,
+        present_df: pd.DataFrame,
+        rules: dict,
+        value_list_index: ValueListIndex,
+        row_hashes: dict,
+        model_names: pd.Series,
+        state: dict,
+    ) -> pd.DataFrame:
+        previous_row_hashes = state["rowHashes"]
+        previous_model_names = state["modelNames"]
+        changed_row_ids = {
+            row_id for row_id, row_hash in row_hashes.items() if previous_row_hashes.get(row_id) != row_hash
+        }
+        removed_row_ids = {row_id for row_id in previous_row_hashes if row_id not in row_hashes}
+        print(
+            f"incremental check of {element_type}: {str(len(changed_row_ids))} changed rows, "
+            f"{str(len(removed_row_ids))} removed rows"
+        )
+        previous_result_df = state["resultDf"]
+        if len(changed_row_ids) == 0 and len(removed_row_ids) == 0:
+            return previous_result_df
+
+        # the model names of a changed row before and after the change
+        affected_model_names = {model_names[row_id] for row_id in changed_row_ids}
+        affected_model_names.update(
+            previous_model_names.get(row_id)
+            for row_id in changed_row_ids | removed_row_ids
+            if row_id in previous_model_names
+        )
+
+        # every rule but uniqueness for the changed rows
+        changed = values_df.index.isin(list(changed_row_ids))
+        changed_result_df = check_element_rules(
+            element_type=element_type,
+            values_df=values_df.loc[changed],
+            present_df=present_df.loc[changed],
+            rules=rules,
+            value_list_index=value_list_index,
+            row_id_column=self.ROW_ID_COLUMN,
+        )
+        changed_result_df = changed_result_df.loc[changed_result_df["Rule"] != UNIQUE_RULE_NAME]
+
+        # uniqueness for all the rows of the affected model names
+        affected = model_names.isin(list(affected_model_names)).to_numpy()
+        unique_rules = {
+            key: {**rule, **NO_RULES, "Must be unique": rule["Must be unique"]} for key, rule in rules.items()
+        }
+        unique_result_df = check_element_rules(
+            element_type=element_type,
+            values_df=values_df.loc[affected],
+            present_df=present_df.loc[affected],
+            rules=unique_rules,
+            value_list_index=value_list_index,
+            row_id_column=self.ROW_ID_COLUMN,
+        )
+        unique_result_df = unique_result_df.loc[unique_result_df["Rule"] == UNIQUE_RULE_NAME]
+        unique_row_ids = set(unique_result_df[self.ROW_ID_COLUMN])
+
+        previous_row_ids = previous_result_df[self.ROW_ID_COLUMN]
+        kept = ~(
+            previous_row_ids.isin(list(changed_row_ids | removed_row_ids))
+            | (previous_row_ids.isin(list(unique_row_ids)) & (previous_result_df["Rule"] == UNIQUE_RULE_NAME))
+        )
+        result_df = pd.concat(
+            [frame for frame in [previous_result_df.loc[kept], changed_result_df, unique_result_df] if not frame.empty],
+            ignore_index=True,
+        )
+        if result_df.empty:
+            return pd.DataFrame(columns=RESULT_COLUMNS + [self.ROW_ID_COLUMN])
+
+        # element by element, then property by property, then rule by rule, like a full check
+        order = numpy.lexsort(
+            (
+                pd.Index(RULE_NAMES).get_indexer(result_df["Rule"]),
+                pd.Index(values_df.columns).get_indexer(result_df["Attribute/ Property"]),
+                values_df.index.get_indexer(result_df[self.ROW_ID_COLUMN]),
+            )
+        )
+        return result_df.iloc[order].reset_index(drop=True)
@@ -0,0 +1,485 @@
+"""
+Reading ifc files as STEP text, without parsing the model
+
+The header of an ifc file (FILE_DESCRIPTION, FILE_NAME, FILE_SCHEMA) is in its first few KB,
+and the IfcApplication is usually one of the first instances of the DATA section.
+get_header_data_from_file reads only those, from a path or a binary stream, and returns the same
+row as functions.get_header_data does for a file opened with ifcopenshell.
+
+iter_raw_instances and read_raw_instance read instances without parsing their parameters (see prefilter.py).
+"""
+
+# packages
+import re
+import json
+import ifcopenshell
+import ifcopenshell.ifcopenshell_wrapper
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# longest "#123 = IFCORGANIZATION (" which can be cut by the end of a block
+MAX_INSTANCE_PREFIX_SIZE = 256
+
+STRING_ESCAPE_PATTERN = re.compile(
+    r"\\X2\\((?:[0-9A-F]{4})+)\\X0\\|\\X4\\((?:[0-9A-F]{8})+)\\X0\\|\\X\\([0-9A-F]{2})|\\S\\(.)|\\P[A-I]\\|\\\\",
+    re.IGNORECASE | re.DOTALL,
+)
+HEADER_STATEMENT_PATTERN = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)\s*\(")
+KEYWORD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+NUMBER_PATTERN = re.compile(r"[-+0-9.Ee]+")
+INSTANCE_PATTERN = re.compile(rb"#(\d+)\s*=\s*([A-Za-z0-9_]+)\s*\(")
+STRING_PATTERN = re.compile(rb"'(?:[^']|'')*'")
+PARAMETER_TOKEN_PATTERN = re.compile(rb"'(?:[^']|'')*'|[(),]")
+REFERENCE_PATTERN = re.compile(rb"#(\d+)")
+
+
+class EntityReference(int):
+    """
+    A reference to another instance (#123) in a parameter list
+    """
+
+    def __repr__(self) -> str:
+        return f"#{int(self)}"
+
+
+def read_header(file) -> dict:
+    """
+    Purpose
+    -------
+    Reads the HEADER section of an ifc file
+
+    Input
+    -----
+    - file: path of the ifc file, or a binary stream positioned at its start
+
+    Output
+    ------
+    - same names as the header of ifcopenshell (ifc_file.wrapped_data.header):
+      {"description": [...], "implementation_level": ..., "name": ..., "time_stamp": ..., "author": [...],
+      "organization": [...], "preprocessor_version": ..., "originating_system": ..., "authorization": ...,
+      "schema_identifiers": [...]}
+    """
+    if isinstance(file, str):
+        with open(file, "rb") as stream:
+            return read_header(file=stream)
+
+    header_text, _ = read_header_section(stream=file)
+    return parse_header(header_text=header_text)
+
+
+def read_header_section(stream) -> tuple:
+    """
+    Output
+    ------
+    - (text of the HEADER section, bytes read after it)
+    """
+    header_bytes, buffer = read_header_bytes(stream=stream)
+    return decode_bytes(data=header_bytes), buffer
+
+
+def read_header_bytes(stream) -> tuple:
+    """
+    Output
+    ------
+    - (HEADER section as it is in the file, bytes read after it)
+    """
+    buffer = b""
+    while True:
+        end = buffer.find(b"ENDSEC;")
+        if end != -1:
+            start = buffer.find(b"HEADER;")
+            start = 0 if start == -1 else start + len(b"HEADER;")
+            return buffer[start:end], buffer[end + len(b"ENDSEC;") :]
+
+        block = stream.read(READ_BLOCK_SIZE)
+        if not block:
+            raise Exception("Could not find the end of the HEADER section of the ifc file")
+        buffer = buffer + block
+
+
+def parse_header(header_text: str) -> dict:
+    header = {}
+    position = 0
+    while True:
+        match = HEADER_STATEMENT_PATTERN.search(header_text, position)
+        if match is None:
+            break
+        parameters, position = parse_list(text=header_text, position=match.end() - 1)
+        name = match.group(1).upper()
+        if name == "FILE_DESCRIPTION":
+            header["description"] = get_parameter(parameters=parameters, index=0, default=[])
+            header["implementation_level"] = get_parameter(parameters=parameters, index=1)
+        elif name == "FILE_NAME":
+            header["name"] = get_parameter(parameters=parameters, index=0)
+            header["time_stamp"] = get_parameter(parameters=parameters, index=1)
+            header["author"] = get_parameter(parameters=parameters, index=2, default=[])
+            header["organization"] = get_parameter(parameters=parameters, index=3, default=[])
+            header["preprocessor_version"] = get_parameter(parameters=parameters, index=4)
+            header["originating_system"] = get_parameter(parameters=parameters, index=5)
+            header["authorization"] = get_parameter(parameters=parameters, index=6)
+        elif name == "FILE_SCHEMA":
+            header["schema_identifiers"] = get_parameter(parameters=parameters, index=0, default=[])
+    return header
+
+
+def get_parameter(parameters: list, index: int, default=None):
+    if index < len(parameters) and parameters[index] is not None:
+        return parameters[index]
+    return default
+
+
+def iter_instances(stream, entity_names: list, buffer: bytes = b""):
+    """
+    Purpose
+    -------
+    Scans the DATA section for instances of some entities, without parsing the other instances
+
+    Input
+    -----
+    - stream: binary stream of the ifc file, anywhere before the instances
+    - entity_names: for example ["IfcApplication"], subtypes are not included
+    - buffer: bytes already read from the stream
+
+    Output
+    ------
+    - yields (id, entity name in upper case, parameters)
+    """
+    names = "|".join(re.escape(entity_name.upper()) for entity_name in entity_names)
+    pattern = re.compile(rb"#(\d+)\s*=\s*(" + names.encode("ascii") + rb")\s*\(", re.IGNORECASE)
+    for instance_id, entity_name, parameters, _ in iter_raw_instances(stream=stream, pattern=pattern, buffer=buffer):
+        values, _ = parse_list(text=decode_bytes(data=parameters), position=0)
+        yield instance_id, entity_name, values
+
+
+def iter_raw_instances(stream, pattern: re.Pattern = INSTANCE_PATTERN, buffer: bytes = b"", offset: int = 0):
+    """
+    Purpose
+    -------
+    Reads the instances of the DATA section block by block, without parsing their parameters
+
+    Input
+    -----
+    - stream: binary stream of the ifc file, anywhere before the instances
+    - pattern: start of the instances to read, "#id = NAME (" with the id and name as groups
+    - buffer: bytes already read from the stream
+    - offset: position of the start of buffer in the file
+
+    Output
+    ------
+    - yields (id, entity name in upper case, parameters as bytes: "(...)", position of the instance in the file)
+    """
+    position = 0
+    while True:
+        block = stream.read(READ_BLOCK_SIZE)
+        offset = offset + position
+        buffer = buffer[position:] + block
+        position = 0
+
+        match = None
+        while True:
+            match = pattern.search(buffer, position)
+            if match is None:
+                break
+            end = find_statement_end(data=buffer, position=match.end())
+            if end is None:
+                # the instance continues in the next block
+                break
+            yield (
+                int(match.group(1)),
+                match.group(2).decode("ascii").upper(),
+                buffer[match.end() - 1 : end].rstrip(),
+                offset + match.start(),
+            )
+            position = end + 1
+
+        if not block:
+            return
+        if match is None:
+            # keep the end of the block, an instance may start there
+            position = max(position, len(buffer) - MAX_INSTANCE_PREFIX_SIZE)
+        else:
+            position = match.start()
+
+
+def read_raw_instance(stream, offset: int) -> tuple:
+    """
+    Reads the instance at a position given by iter_raw_instances
+
+    Output
+    ------
+    - (id, entity name in upper case, parameters as bytes: "(...)")
+    """
+    stream.seek(offset)
+    buffer = b""
+    size = 4096
+    while True:
+        block = stream.read(size)
+        buffer = buffer + block
+        match = INSTANCE_PATTERN.match(buffer)
+        end = find_statement_end(data=buffer, position=match.end()) if match else None
+        if end is not None:
+            return int(match.group(1)), match.group(2).decode("ascii").upper(), buffer[match.end() - 1 : end].rstrip()
+        if not block:
+            raise Exception(f"Could not read the ifc instance at position {str(offset)}")
+        size = size * 2
+
+
+def split_parameters(parameters: bytes) -> list:
+    """
+    Splits "(a,(b,c),'d,e')" into [b"a", b"(b,c)", b"'d,e'"], without parsing the values
+    """
+    values = []
+    depth = 0
+    start = 1
+    for match in PARAMETER_TOKEN_PATTERN.finditer(parameters):
+        token = match.group(0)
+        if token == b"(":
+            depth = depth + 1
+        elif token == b")":
+            depth = depth - 1
+            if depth == 0:
+                values.append(parameters[start : match.start()].strip())
+                break
+        elif token == b"," and depth == 1:
+            values.append(parameters[start : match.start()].strip())
+            start = match.end()
+    if values == [b""]:
+        return []
+    return values
+
+
+def get_references(parameters: bytes) -> list:
+    """
+    The ids of the instances referenced (#123) in parameters as bytes
+    """
+    if b"'" in parameters:
+        parameters = STRING_PATTERN.sub(b"''", parameters)
+    return [int(reference) for reference in REFERENCE_PATTERN.findall(parameters)]
+
+
+def find_statement_end(data: bytes, position: int):
+    # position of the ";" ending the statement, skipping strings. None if it is not in data
+    while True:
+        end = data.find(b";", position)
+        quote = data.find(b"'", position)
+        if end == -1:
+            return None
+        if quote == -1 or end < quote:
+            return end
+
+        # skip the string, '' is an escaped quote
+        position = quote + 1
+        while True:
+            quote = data.find(b"'", position)
+            if quote == -1 or quote + 1 == len(data):
+                return None
+            if data[quote + 1 : quote + 2] == b"'":
+                position = quote + 2
+                continue
+            position = quote + 1
+            break
+
+
+def parse_list(text: str, position: int) -> tuple:
+    """
+    Parses the parameter list starting with "(" at position
+
+    Output
+    ------
+    - (list of values, position after the closing ")")
+    """
+    values = []
+    position = skip_whitespace(text=text, position=position + 1)
+    if text[position] == ")":
+        return values, position + 1
+
+    while True:
+        value, position = parse_value(text=text, position=position)
+        values.append(value)
+        position = skip_whitespace(text=text, position=position)
+        if text[position] == ")":
+            return values, position + 1
+        if text[position] != ",":
+            raise Exception(f"Unexpected character in STEP parameters: {text[position : position + 20]}")
+        position = position + 1
+
+
+def parse_value(text: str, position: int) -> tuple:
+    position = skip_whitespace(text=text, position=position)
+    character = text[position]
+
+    if character == "'":
+        end = position + 1
+        while True:
+            end = text.index("'", end)
+            if text[end + 1 : end + 2] == "'":
+                end = end + 2
+                continue
+            break
+        return decode_string(text=text[position + 1 : end]), end + 1
+
+    if character == "(":
+        return parse_list(text=text, position=position)
+
+    if character in "$*":
+        return None, position + 1
+
+    if character == "#":
+        match = NUMBER_PATTERN.match(text, position + 1)
+        return EntityReference(int(match.group(0))), match.end()
+
+    if character == ".":
+        end = text.index(".", position + 1)
+        enumeration = text[position + 1 : end].upper()
+        return {"T": True, "F": False, "U": "UNKNOWN"}.get(enumeration, enumeration), end + 1
+
+    if character == '"':
+        end = text.index('"', position + 1)
+        return text[position + 1 : end], end + 1
+
+    match = KEYWORD_PATTERN.match(text, position)
+    if match:
+        # typed value, for example IFCLABEL('Name')
+        values, position = parse_list(text=text, position=skip_whitespace(text=text, position=match.end()))
+        return (values[0] if len(values) == 1 else values), position
+
+    match = NUMBER_PATTERN.match(text, position)
+    if match is None:
+        raise Exception(f"Unexpected character in STEP parameters: {text[position : position + 20]}")
+    number = match.group(0)
+    if any(character in number for character in ".Ee"):
+        return float(number), match.end()
+    return int(number), match.end()
+
+
+def skip_whitespace(text: str, position: int) -> int:
+    while text[position].isspace():
+        position = position + 1
+    return position
+
+
+def decode_bytes(data: bytes) -> str:
+    # STEP files should be ascii with escapes, but raw utf-8 is common
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+
+def decode_string(text: str) -> str:
+    """
+    Decodes a STEP string: '' quotes, \\X2\\ and \\X4\\ unicode, \\X\\ and \\S\\ 8 bit characters
+    """
+    text = text.replace("''", "'")
+    if "\\" not in text:
+        return text
+    return STRING_ESCAPE_PATTERN.sub(decode_escape, text)
+
+
+def decode_escape(match: re.Match) -> str:
+    if match.group(1):
+        return bytes.fromhex(match.group(1)).decode("utf-16-be")
+    if match.group(2):
+        return bytes.fromhex(match.group(2)).decode("utf-32-be")
+    if match.group(3):
+        return chr(int(match.group(3), 16))
+    if match.group(4):
+        return chr(ord(match.group(4)) + 128)
+    if match.group(0) == "\\\\":
+        return "\\"
+    # code page switches (\PA\) only change how \S\ characters are read
+    return ""
+
+
+def get_application(stream, schema: str, buffer: bytes = b"") -> dict:
+    """
+    Purpose
+    -------
+    Finds the first IfcApplication of the DATA section, and its ApplicationDeveloper organization,
+    reading the file only until both are found
+
+    Output
+    ------
+    - {"application": info, "developer": info}, where info is like entity.get_info(), or None
+    """
+    organizations = {}
+    application = None
+    for instance_id, entity_name, parameters in iter_instances(
+        stream=stream, entity_names=["IfcApplication", "IfcOrganization"], buffer=buffer
+    ):
+        info = get_info(schema=schema, entity_name=entity_name, instance_id=instance_id, parameters=parameters)
+        if entity_name == "IFCORGANIZATION":
+            organizations[instance_id] = info
+        elif application is None:
+            application = info
+
+        if application is not None and application.get("ApplicationDeveloper") in organizations:
+            break
+
+    if application is None:
+        return {"application": None, "developer": None}
+    return {"application": application, "developer": organizations.get(application.get("ApplicationDeveloper"))}
+
+
+def get_info(schema: str, entity_name: str, instance_id: int, parameters: list) -> dict:
+    # same keys as entity.get_info(): id, type, then the attributes of the schema
+    declaration = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema).declaration_by_name(entity_name)
+    info = {"id": instance_id, "type": declaration.name()}
+    for attribute, value in zip(declaration.all_attributes(), parameters):
+        info[attribute.name()] = value
+    return info
+
+
+def get_header_data_from_file(file, model_name: str) -> dict:
+    """
+    Purpose
+    -------
+    Same as functions.get_header_data, reading only the header and the IfcApplication of the file
+
+    Input
+    -----
+    - file: path of the ifc file, or a binary stream positioned at its start
+    - model_name: value of "Name + Revision"
+    """
+    if isinstance(file, str):
+        with open(file, "rb") as stream:
+            return get_header_data_from_file(file=stream, model_name=model_name)
+
+    header_text, buffer = read_header_section(stream=file)
+    header = parse_header(header_text=header_text)
+    schema_identifiers = header.get("schema_identifiers") or []
+    try:
+        application_data = get_application(stream=file, schema=schema_identifiers[0], buffer=buffer)
+    except Exception:
+        application_data = {"application": None, "developer": None}
+    application = application_data["application"] or {}
+
+    full_name = header.get("name") or ""
+    file_name = full_name.split("/")[-1]
+    new_row = {}
+    new_row["Name + Revision"] = model_name
+    new_row["ApplicationFullName"] = application.get("ApplicationFullName")
+    new_row["ApplicationDeveloper"] = get_json(data=application_data["developer"])
+    new_row["Version"] = application.get("Version")
+    new_row["ApplicationIdentifier"] = application.get("ApplicationIdentifier")
+    new_row["ContainerName"] = file_name
+    new_row["Key"] = file_name
+    new_row["Organization"] = get_parameter(parameters=header.get("organization") or [], index=0)
+    new_row["Description"] = ", ".join(header.get("description") or [])
+    new_row["ImplementationLevel"] = header.get("implementation_level")
+    new_row["Name"] = full_name[full_name.rfind("/") + 1 :] if full_name else None
+    new_row["TimeStamp"] = header.get("time_stamp")
+    new_row["Author"] = ", ".join(header.get("author") or [])
+    new_row["PreprocessorVersion"] = header.get("preprocessor_version")
+    new_row["OriginatingSystem"] = header.get("originating_system")
+    new_row["FileSchema"] = get_parameter(parameters=schema_identifiers, index=0)
+    new_row["Authorization"] = header.get("authorization")
+
+    return new_row
+
+
+def get_json(data: dict):
+    # like functions.get_application_developer, an organization with references (roles, addresses) gives None
+    if data is None or any(isinstance(value, (EntityReference, list)) for value in data.values()):
+        return None
+    return json.dumps(data)
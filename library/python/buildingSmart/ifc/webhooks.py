@@ -1,7 +1,9 @@
 # packages
+import os
 import time
 import json
 import requests
+import tempfile
 import traceback
 import pandas as pd
 
@@ -10,11 +12,22 @@ import library.python.morta.api as ma
 import library.python.morta.functions as mf
 import library.python.pandas.functions as pf
 import library.python.buildingSmart.ifc.functions as ifc_functions
-
+import library.python.buildingSmart.ifc.cache as ifc_cache
+import library.python.buildingSmart.ifc.diff as ifc_diff
+import library.python.buildingSmart.ifc.writeback as ifc_writeback
+import library.python.buildingSmart.ifc.step as ifc_step
+import library.python.buildingSmart.ifc.prefilter as ifc_prefilter
 
 EXTRACT_ENDPOINT = "https://services.morta.io/ifc/tool/viewpoint/extract"
 WRITE_ENDPOINT = "https://services.morta.io/ifc/tool/viewpoint/write"
 
+# extraction results are cached by file content, so that extracting the same revision again skips parsing
+# set EXTRACTION_CACHE_DIRECTORY to None to disable the cache
+EXTRACTION_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), "morta_ifc_extraction_cache")
+EXTRACTION_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+# downloaded ifc files can also be kept, so that a cached revision is not downloaded again
+VIEWPOINT_FILE_CACHE_DIRECTORY = None
+
 
 def process_cell_update(webhook_response: dict):
     updates = []
@@ -117,11 +130,6 @@ def extract_next_file(webhook_response: dict, testing: bool):
             revision_id = row_data["Revision ID"]
             ifc_file_name = row_data["Name + Revision"]
 
-            # get the file file
-            ifc_file = ifc_functions.get_viewpoint_file(
-                document_id=document_id, revision_id=revision_id, api_key=api_key
-            )
-
             # get the ifc_entities
             filters = [{"columnName": "Extract", "value": True, "filterType": "eq", "orGroup": "main"}]
             ifc_entity_rows = ma.get_table_rows(table_id=ifc_entities_table_id, filters=filters)
@@ -129,8 +137,14 @@ def extract_next_file(webhook_response: dict, testing: bool):
                 raise Exception(f"No ifc types for extraction in project {project_id} in table {ifc_entities_table_id}")
             ifc_types = [row["rowData"]["IFC Entity"] for row in ifc_entity_rows]
 
-            # extract the ifc file
-            result_df = ifc_functions.extract_ifc_file(ifc_file=ifc_file, ifc_types=ifc_types)
+            # get the file and extract it, unless the same file was already extracted for the same types
+            result_df, header_row = extract_viewpoint_file(
+                document_id=document_id,
+                revision_id=revision_id,
+                ifc_types=ifc_types,
+                model_name=ifc_file_name,
+                api_key=api_key,
+            )
 
             result_df["Revision Id"] = revision_id
             if "Attributes - GlobalId" not in result_df.columns.values:
@@ -148,12 +162,15 @@ def extract_next_file(webhook_response: dict, testing: bool):
             Duplicates might occur:
             For example, if you get the "IfcAirTerminalType" elements in the Ifc
             and then get the "IfcFlowTerminalType" elements, they will be the same exact list
-            because IfcFlowTerminalType is a subtype of IfcAirTerminalType
+            because IfcAirTerminalType is a subtype of IfcFlowTerminalType
+            extract_ifc_file now extracts such elements once (see plan_extraction), this is kept as a safety net
             """
             result_df = result_df.drop_duplicates(subset=["Key"])
 
+            # the hash of each element is stored with its row, so that a new extraction only pushes the changes
+            result_df = ifc_diff.add_element_hashes(input_df=result_df)
+
             # get header data
-            header_row = ifc_functions.get_header_data(ifc_file=ifc_file, model_name=ifc_file_name)
             header_df = pd.DataFrame(data=[header_row])
             header_df["Revision Id"] = revision_id
 
@@ -211,7 +228,7 @@ def extract_next_file(webhook_response: dict, testing: bool):
                 result_df = result_df.rename(columns=column_mapping)
                 result_df = result_df.rename(columns=ifc_data_table_column_mapping)
 
-                # insert rows
+                # push the elements which were added, removed or changed since the rows of this revision were written
                 result_df = ifc_functions.check_datatypes(df=result_df, ifc_data_table_id=ifc_data_table_id)
                 ifc_data_rows = pf.dataframe_to_morta_rows(input_df=result_df)
                 filters = [
@@ -222,8 +239,14 @@ def extract_next_file(webhook_response: dict, testing: bool):
                         "orGroup": "main",
                     }
                 ]
-                mf.delete_rows_by_filter(table_id=ifc_data_table_id, filters=filters)
-                ma.insert_rows(table_id=ifc_data_table_id, rows=ifc_data_rows)
+                previous_rows = ma.get_table_rows(table_id=ifc_data_table_id, filters=filters)
+                element_changes = ifc_diff.diff_element_rows(
+                    new_rows=ifc_data_rows,
+                    previous_rows=previous_rows,
+                    key_column=ifc_data_table_column_mapping[column_mapping["Key"]],
+                    hash_column=ifc_data_table_column_mapping[column_mapping[ifc_diff.ELEMENT_HASH_COLUMN]],
+                )
+                ifc_diff.push_element_changes(table_id=ifc_data_table_id, changes=element_changes)
 
                 # header
                 ifc_header_table_name = "IFC Header"
@@ -309,6 +332,51 @@ def extract_next_file(webhook_response: dict, testing: bool):
         raise Exception(traceback.format_exc())
 
 
+def extract_viewpoint_file(
+    document_id: str, revision_id: str, ifc_types: list, model_name: str, api_key: str = None
+) -> tuple:
+    """
+    Downloads and extracts a viewpoint ifc file, using the extraction cache if it is enabled
+
+    returns (result_df, header_row)
+    """
+    file_data = ifc_functions.download_viewpoint_file(
+        document_id=document_id,
+        revision_id=revision_id,
+        api_key=api_key,
+        cache_directory=VIEWPOINT_FILE_CACHE_DIRECTORY,
+    )
+    try:
+        extraction_cache = get_extraction_cache()
+        if extraction_cache:
+            cached = extraction_cache.get(content_hash=file_data["contentHash"], ifc_types=ifc_types)
+            if cached:
+                result_df, header_row = cached
+                header_row["Name + Revision"] = model_name
+                return result_df, header_row
+
+        # the header and application are read from the STEP text, without waiting for the model to be parsed
+        header_row = ifc_step.get_header_data_from_file(file=file_data["filePath"], model_name=model_name)
+        # large files are reduced to the elements of ifc_types before they are parsed
+        ifc_file = ifc_prefilter.open_ifc_file(file_path=file_data["filePath"], ifc_types=ifc_types)
+    finally:
+        ifc_functions.remove_viewpoint_file(file_data=file_data)
+
+    result_df = ifc_functions.extract_ifc_file(ifc_file=ifc_file, ifc_types=ifc_types)
+    if extraction_cache:
+        extraction_cache.put(
+            content_hash=file_data["contentHash"], ifc_types=ifc_types, result_df=result_df, header_row=header_row
+        )
+    return result_df, header_row
+
+
+def get_extraction_cache():
+    # the cache is skipped when it is disabled or pyarrow is not installed
+    if not EXTRACTION_CACHE_DIRECTORY or pf.pq is None:
+        return None
+    return ifc_cache.ExtractionCache(directory=EXTRACTION_CACHE_DIRECTORY, max_size=EXTRACTION_CACHE_MAX_SIZE)
+
+
 def write_request_process_row_add(webhook_response: dict):
     post_write_request(webhook_response=webhook_response)
 
@@ -417,6 +485,7 @@ def write_next_file(webhook_response: dict, testing: bool):
                     if column_id1 == column_id2:
                         column_mapping[current_column_name] = original_column_name
 
+            write_back_index = ifc_writeback.WriteBackIndex(ifc_file=ifc_file)
             for row in ifc_data_table_rows:
                 row_id = row["publicId"]
                 old_row_data: dict = row["rowData"]
@@ -427,92 +496,31 @@ def write_next_file(webhook_response: dict, testing: bool):
                     if current_column_name in column_mapping:
                         row_data[column_mapping[current_column_name]] = old_row_data[current_column_name]
 
-                guid = row_data["Attributes - GlobalId"]
-
-                try:
-                    element = ifc_file.by_guid(guid=guid)
-                except Exception:
+                # rows of elements which are not in the file are left as changed
+                if not ifc_writeback.write_row(write_back_index=write_back_index, row_data=row_data):
                     continue
 
-                for column, value in row_data.items():
-                    if " - " in column:
-                        pset_name = column.split(" - ")[0]
-                        prop_name = column.split(" - ")[1]
-
-                        if pset_name == "Attributes" and prop_name not in ["id", "type", "GlobalId"] and value:
-                            if value[0:1] != "#":
-                                try:
-                                    exec(f"element.{prop_name} = value")
-                                except Exception as c:
-                                    if "Expected Double" in str(c) or "setArgumentAsDouble" in str(c):
-                                        exec(f"element.{prop_name} = float(value)")
-                                    elif "Expected Int" in str(c) or "setArgumentAsInt" in str(c):
-                                        exec(f"element.{prop_name} = int(value)")
-                                    elif "Expected Boolean" in str(c):
-                                        exec(f"element.{prop_name} = float(value)")
-                                    else:
-                                        print("stop")
-
-                        else:
-                            definitions = (
-                                element.IsDefinedBy if hasattr(element, "IsDefinedBy") and element.IsDefinedBy else ()
-                            )
-                            property_sets = (
-                                element.HasPropertySets
-                                if hasattr(element, "HasPropertySets") and element.HasPropertySets
-                                else ()
-                            )
-                            definitions = definitions + property_sets
-
-                            for definition in definitions:
-                                # for ifc elements, there is something called RelatingPropertyDefinition
-                                # under which, there's another thing called HasProperties
-                                # under which we find the properties
-                                if hasattr(definition, "RelatingPropertyDefinition"):
-                                    relating_prop = definition.RelatingPropertyDefinition
-                                # for ifc types, the HasProperties is directly under the definition
-                                else:
-                                    relating_prop = definition
-
-                                if hasattr(relating_prop, "HasProperties"):
-                                    if relating_prop.Name == pset_name:
-                                        props = relating_prop.HasProperties
-                                        for prop in props:
-                                            if len(ifc_file.get_inverse(prop)) > 1:
-                                                continue
-                                            if prop.Name == prop_name:
-                                                if hasattr(prop, "NominalValue"):
-                                                    if "IfcReal" in str(prop.NominalValue):
-                                                        prop.NominalValue.wrappedValue = float(value) if value else None
-                                                    else:
-                                                        try:
-                                                            prop.NominalValue.wrappedValue = value
-                                                        except Exception as c:
-                                                            if "Expected Double" in str(
-                                                                c
-                                                            ) or "setArgumentAsDouble" in str(c):
-                                                                prop.NominalValue.wrappedValue = float(value)
-                                                            elif "Expected Int" in str(c) or "setArgumentAsInt" in str(
-                                                                c
-                                                            ):
-                                                                prop.NominalValue.wrappedValue = int(value)
-                                                            else:
-                                                                print("stop")
-
                 updates.append({"columnName": "Changed?", "rowId": row_id, "value": None})
 
-            ifc_text = ifc_file.to_string()
-            bytes_object = bytes(ifc_text, encoding="utf-8")
-
-            # upload to viewpoint
-            ifc_functions.upload_document_to_viewpoint(
-                document_id=document_id,
-                document_name=document_name,
-                bytes_object=bytes_object,
-                user_name=user_name,
-                password=password,
-                api_key=api_key,
-            )
+            # write the model to a temporary file and stream it from there,
+            # instead of holding its text and bytes in memory next to the model
+            file_descriptor, ifc_file_path = tempfile.mkstemp(suffix=".ifc")
+            os.close(file_descriptor)
+            try:
+                ifc_file.write(ifc_file_path)
+                del ifc_file, write_back_index
+
+                # upload to viewpoint
+                ifc_functions.upload_document_to_viewpoint(
+                    document_id=document_id,
+                    document_name=document_name,
+                    file_path=ifc_file_path,
+                    user_name=user_name,
+                    password=password,
+                    api_key=api_key,
+                )
+            finally:
+                os.remove(ifc_file_path)
 
             ma.update_cells(table_id=ifc_data_table_id, cells=updates)
 
@@ -0,0 +1,239 @@
+"""
+Writing the values edited in Morta back into an ifc file
+
+For each changed cell, the write-back used to walk all the property sets of the element, count the
+inverses of every property on the way, and set attributes with exec, retrying with float and int
+when ifcopenshell rejected the value. Here:
+- WriteBackIndex finds the properties of an element by (GlobalId, property set name, property name),
+  and knows which properties are shared by more than one property set (those are never written)
+- values are converted once to the type the schema declares for the attribute or property value
+"""
+
+# packages
+import functools
+import ifcopenshell
+import ifcopenshell.ifcopenshell_wrapper
+
+# attributes which are never written back
+READ_ONLY_ATTRIBUTES = ["id", "type", "GlobalId"]
+
+
+class WriteBackIndex:
+    """
+    Purpose
+    -------
+    The properties of the elements of one ifc file:
+    - (GlobalId, property set name, property name) -> properties, read the first time an element is written
+    - the properties shared by more than one property set or complex property, read once
+
+    Input
+    -----
+    - ifc_file is the result of ifcopenshell.open function
+    """
+
+    def __init__(self, ifc_file: ifcopenshell.file):
+        self.ifc_file = ifc_file
+        self.element_properties = {}
+
+        property_counts = {}
+        for ifc_type in ["IfcPropertySet", "IfcComplexProperty"]:
+            try:
+                entities = ifc_file.by_type(ifc_type)
+            except Exception:
+                entities = []
+            for entity in entities:
+                for prop in entity.HasProperties or ():
+                    property_counts[prop.id()] = property_counts.get(prop.id(), 0) + 1
+        self.shared_properties = {prop_id for prop_id, count in property_counts.items() if count > 1}
+
+    def get_element(self, guid: str):
+        try:
+            return self.ifc_file.by_guid(guid)
+        except Exception:
+            return None
+
+    def get_properties(self, element: ifcopenshell.entity_instance, pset_name: str, prop_name: str) -> list:
+        guid = element.GlobalId
+        if guid not in self.element_properties:
+            self.element_properties[guid] = self.index_element(element=element)
+        return self.element_properties[guid].get((pset_name, prop_name), [])
+
+    def index_element(self, element: ifcopenshell.entity_instance) -> dict:
+        properties = {}
+        definitions = element.IsDefinedBy if hasattr(element, "IsDefinedBy") and element.IsDefinedBy else ()
+        property_sets = (
+            element.HasPropertySets if hasattr(element, "HasPropertySets") and element.HasPropertySets else ()
+        )
+        for definition in definitions + property_sets:
+            # for ifc elements, the property set is the RelatingPropertyDefinition of the relationship
+            # for ifc types, the property set is the definition itself
+            if hasattr(definition, "RelatingPropertyDefinition"):
+                property_set = definition.RelatingPropertyDefinition
+            else:
+                property_set = definition
+            if not hasattr(property_set, "HasProperties"):
+                continue
+            for prop in property_set.HasProperties or ():
+                if prop.id() in self.shared_properties:
+                    continue
+                properties.setdefault((property_set.Name, prop.Name), []).append(prop)
+        return properties
+
+
+def write_row(write_back_index: WriteBackIndex, row_data: dict) -> bool:
+    """
+    Purpose
+    -------
+    Writes the values of an ifc data row into its element
+
+    Input
+    -----
+    - write_back_index: WriteBackIndex of the ifc file
+    - row_data: {"Attributes - Name": value, "<Pset> - <Property>": value, ...} with the original column names
+
+    Output
+    ------
+    - False if the element of the row is not in the ifc file
+    """
+    element = write_back_index.get_element(guid=row_data.get("Attributes - GlobalId"))
+    if element is None:
+        return False
+
+    for column, value in row_data.items():
+        if " - " not in column:
+            continue
+        pset_name = column.split(" - ")[0]
+        prop_name = column.split(" - ")[1]
+
+        if pset_name == "Attributes":
+            # references to other entities (#123) are not written
+            if prop_name not in READ_ONLY_ATTRIBUTES and value and str(value)[0:1] != "#":
+                write_attribute(element=element, attribute_name=prop_name, value=value)
+        else:
+            for prop in write_back_index.get_properties(element=element, pset_name=pset_name, prop_name=prop_name):
+                write_property_value(prop=prop, value=value)
+
+    return True
+
+
+def write_attribute(element: ifcopenshell.entity_instance, attribute_name: str, value) -> bool:
+    try:
+        convert = get_attribute_converter(
+            schema=element.is_a(True).split(".")[0], ifc_class=element.is_a(), attribute_name=attribute_name
+        )
+        setattr(element, attribute_name, None if is_empty(value=value) else convert(value))
+        return True
+    except Exception as error:
+        print(f"could not write attribute {attribute_name} of {element.GlobalId}: {error}")
+        return False
+
+
+def write_property_value(prop: ifcopenshell.entity_instance, value) -> bool:
+    nominal_value = getattr(prop, "NominalValue", None)
+    if nominal_value is None:
+        return False
+    try:
+        # empty cells unset the value
+        if is_empty(value=value):
+            nominal_value.wrappedValue = None
+            return True
+        convert = get_type_converter(schema=prop.is_a(True).split(".")[0], type_name=nominal_value.is_a())
+        nominal_value.wrappedValue = convert(value)
+        return True
+    except Exception as error:
+        print(f"could not write property {prop.Name}: {error}")
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def get_attribute_converter(schema: str, ifc_class: str, attribute_name: str):
+    """
+    The function converting a value to the type of an attribute, for example float for an IfcLengthMeasure
+    """
+    declaration = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema).declaration_by_name(ifc_class)
+    for attribute in declaration.all_attributes():
+        if attribute.name() == attribute_name:
+            return CONVERTERS.get(get_simple_type(parameter_type=attribute.type_of_attribute()), keep_value)
+    raise Exception(f"{ifc_class} has no attribute {attribute_name}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_type_converter(schema: str, type_name: str):
+    """
+    The function converting a value to a defined type, for example float for IfcReal
+    """
+    declaration = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema).declaration_by_name(type_name)
+    if declaration.as_type_declaration() is None:
+        return keep_value
+    return CONVERTERS.get(get_simple_type(parameter_type=declaration.as_type_declaration().declared_type()), keep_value)
+
+
+def get_simple_type(parameter_type) -> str:
+    """
+    The simple type (real, integer, string, ...) a schema type is defined as,
+    None for entities, selects and aggregates
+    """
+    while True:
+        named_type = parameter_type.as_named_type()
+        if named_type is not None:
+            declaration = named_type.declared_type()
+            if declaration.as_type_declaration() is not None:
+                parameter_type = declaration.as_type_declaration().declared_type()
+                continue
+            if declaration.as_enumeration_type() is not None:
+                return "enumeration"
+            return None
+
+        simple_type = parameter_type.as_simple_type()
+        if simple_type is not None:
+            return simple_type.declared_type()
+        return None
+
+
+def is_empty(value) -> bool:
+    return value is None or (isinstance(value, str) and value == "")
+
+
+def keep_value(value):
+    return value
+
+
+def to_float(value):
+    return float(value) if not is_empty(value=value) else None
+
+
+def to_int(value):
+    return int(float(value)) if not is_empty(value=value) else None
+
+
+def to_bool(value) -> bool:
+    if is_empty(value=value):
+        return None
+    if isinstance(value, str):
+        return value.strip().lower() in ["true", "yes", "1", ".t."]
+    return bool(value)
+
+
+def to_logical(value):
+    if is_empty(value=value):
+        return None
+    if isinstance(value, str) and value.strip().lower() in ["unknown", ".u."]:
+        return "UNKNOWN"
+    return to_bool(value=value)
+
+
+def to_text(value) -> str:
+    if is_empty(value=value):
+        return None
+    return value if isinstance(value, str) else str(value)
+
+
+CONVERTERS = {
+    "real": to_float,
+    "number": to_float,
+    "integer": to_int,
+    "boolean": to_bool,
+    "logical": to_logical,
+    "string": to_text,
+    "enumeration": to_text,
+}
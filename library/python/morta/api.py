@@ -1,16 +1,30 @@
 # packages
+import os
 import json
+import mmap
+import uuid
 import requests
 import urllib
+import inspect
+import tempfile
+import functools
+import mimetypes
+import threading
 import traceback
+import contextvars
 from enum import Enum
-from time import sleep
+from typing import Iterator
+from time import sleep, monotonic
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # global variables
 URL = "https://api.morta.io"
 DEFAULT_MORTA_USER_TOKEN = ""
 MAX_ROW_COUNT_LIMIT_ON_INSERT = 2500
 MAX_API_CALL_TRIES = 3
+FILE_TRANSFER_CHUNK_SIZE = 1024 * 1024
+MAX_FILE_TRANSFER_WORKERS = 4
 
 
 class Role(Enum):
@@ -32,6 +46,292 @@ class AttributeKind(Enum):
     project = "project"
 
 
+class RateLimiter:
+    """
+    Spaces out api calls so that at most max_calls_per_second are started per second.
+    Shared by all the threads using the same client.
+    """
+
+    def __init__(self, max_calls_per_second: float):
+        self.interval = 1 / max_calls_per_second
+        self.next_call_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            wait_time = self.next_call_time - now
+            self.next_call_time = max(now, self.next_call_time) + self.interval
+        if wait_time > 0:
+            sleep(wait_time)
+
+
+class MortaClient:
+    """
+    Purpose
+    -------
+    Holds the configuration used to call the Morta api for one tenant:
+    - token and base url
+    - a pooled requests session
+    - retry policy: max_tries and the status codes to retry on
+    - optional rate limiter: max_calls_per_second
+    - optional cache of GET responses: cache_seconds, at most cache_max_entries responses.
+      the cache is cleared by every POST, PUT and DELETE call of the client
+
+    Every function of this module is available on the client and runs with its configuration:
+        client = MortaClient(token=api_key, max_calls_per_second=10)
+        rows = client.get_table_rows(table_id=table_id)
+
+    Code that calls the module functions (including other modules of this repo) can be run
+    with a client for a whole block. Clients are isolated per thread and per task:
+        with client.activate():
+            ifc_functions.check_rules(...)
+
+    The module functions use the default client, which reads URL, DEFAULT_MORTA_USER_TOKEN
+    and MAX_API_CALL_TRIES when each call is made. A per-call api_key still overrides the token.
+    """
+
+    def __init__(
+        self,
+        token: str = None,
+        url: str = None,
+        max_tries: int = None,
+        retry_status_codes: list = [502, 500, 429, 503],
+        max_calls_per_second: float = None,
+        cache_seconds: float = 0,
+        cache_max_entries: int = 256,
+        pool_size: int = 10,
+    ):
+        self.token = token
+        self.url = url
+        self.max_tries = max_tries
+        self.retry_status_codes = retry_status_codes
+        self.rate_limiter = RateLimiter(max_calls_per_second) if max_calls_per_second else None
+        self.cache_seconds = cache_seconds
+        self.cache_max_entries = cache_max_entries
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get_url(self) -> str:
+        return self.url if self.url is not None else URL
+
+    def get_token(self) -> str:
+        return self.token if self.token is not None else DEFAULT_MORTA_USER_TOKEN
+
+    def get_max_tries(self) -> int:
+        return self.max_tries if self.max_tries is not None else MAX_API_CALL_TRIES
+
+    @contextmanager
+    def activate(self):
+        context_token = _active_client.set(self)
+        try:
+            yield self
+        finally:
+            _active_client.reset(context_token)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Runs a function with this client active, in a copy of the current context.
+        Generator functions return a generator which runs each step with this client.
+        """
+        context = contextvars.copy_context()
+        context.run(_active_client.set, self)
+        if inspect.isgeneratorfunction(function):
+            return _run_generator_in_context(context, function, *args, **kwargs)
+        return context.run(function, *args, **kwargs)
+
+    def __getattr__(self, name: str):
+        function = globals().get(name)
+        if name.startswith("_") or not inspect.isfunction(function):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        @functools.wraps(function)
+        def call_with_client(*args, **kwargs):
+            return self.run(function, *args, **kwargs)
+
+        return call_with_client
+
+    def clear_cache(self):
+        with self.cache_lock:
+            self.cache = {}
+
+    def store_cached_response(self, cache_key: tuple, response: requests.Response):
+        now = monotonic()
+        with self.cache_lock:
+            # expired responses are dropped, then the oldest ones if the cache is still full
+            self.cache = {key: cached for key, cached in self.cache.items() if cached[0] > now}
+            self.cache.pop(cache_key, None)
+            while self.cache and len(self.cache) >= self.cache_max_entries:
+                self.cache.pop(next(iter(self.cache)))
+            self.cache[cache_key] = (now + self.cache_seconds, response)
+
+    def api_call(
+        self,
+        method: str,
+        endpoint: str,
+        params: dict = None,
+        tries: int = 0,
+        api_key: str = None,
+        data: dict = None,
+        files: list = None,
+        extra_headers: dict = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        # checking if the method is one of the accepted values
+        assert method in ["GET", "POST", "PUT", "DELETE"], "method should be one of GET, POST, PUT, DELETE"
+
+        if api_key is not None:
+            user_token = api_key
+        else:
+            user_token = self.get_token()
+
+        # constructing headers and url
+        headers = {
+            "Accept": "application/json",
+            "Authorization": f"Bearer {user_token}",
+        }
+        if extra_headers:
+            headers.update(extra_headers)
+        dest_url = f"{self.get_url()}{endpoint}"
+        max_tries = self.get_max_tries()
+        # print(f"{method}: {dest_url}")
+
+        # serve repeated GET calls from the cache if it is enabled
+        cache_key = None
+        if method == "GET" and not stream and self.cache_seconds > 0:
+            cache_key = (user_token, dest_url, json.dumps(params, sort_keys=True, default=str))
+            with self.cache_lock:
+                cached = self.cache.get(cache_key)
+            if cached and cached[0] > monotonic():
+                return cached[1]
+
+        # streamed bodies are consumed by a failed attempt, so rewind them before every try
+        if hasattr(data, "seek"):
+            data.seek(0)
+
+        if self.rate_limiter:
+            self.rate_limiter.wait()
+
+        # try executing the api request. if failed, wait for 1 second and retry if tries < Max number of tries
+        # otherwise, raise and exception
+        try:
+            if method == "GET":
+                response = self.session.get(url=dest_url, headers=headers, params=params, stream=stream)
+            elif method == "POST":
+                if data and files:
+                    response = self.session.post(url=dest_url, files=files, data=data, headers=headers)
+                elif files:
+                    response = self.session.post(url=dest_url, files=files, headers=headers)
+                elif hasattr(data, "read"):
+                    response = self.session.post(url=dest_url, data=data, headers=headers)
+                else:
+                    response = self.session.post(url=dest_url, headers=headers, json=params, stream=stream)
+            elif method == "PUT":
+                response = self.session.put(url=dest_url, headers=headers, json=params)
+            elif method == "DELETE":
+                response = self.session.delete(url=dest_url, headers=headers, json=params)
+        except Exception:
+            sleep(1)
+            tries = tries + 1
+            if tries < max_tries:
+                return self.api_call(
+                    method=method,
+                    endpoint=endpoint,
+                    params=params,
+                    data=data,
+                    files=files,
+                    tries=tries,
+                    api_key=api_key,
+                    extra_headers=extra_headers,
+                    stream=stream,
+                )
+            else:
+                raise Exception(f"Exception:\n{traceback.format_exc()}")
+
+        # a write can change what any cached GET returns
+        if method != "GET" and self.cache:
+            self.clear_cache()
+
+        # if the response code is not 200 or 201:
+        if response.status_code != 200 and response.status_code != 201:
+            # increase the tries and log the response
+            tries = tries + 1
+            log_responses(response)
+            sleep_time = 1
+
+            # if the response status code is one of the retry status codes and max tries have not been reached yet
+            # wait for 1 second, log the response
+            # response 429 happens when more than 10 api calls are made on a resource in a second
+            if response.status_code in self.retry_status_codes and tries < max_tries:
+                # only for the 429 error, we need to incrementally increase the wait time.
+                if response.status_code in [429]:
+                    sleep_time = tries * 2
+
+                sleep(sleep_time)
+                print(f"retrying api call. total tries: {str(tries)}")
+                return self.api_call(
+                    method=method,
+                    endpoint=endpoint,
+                    params=params,
+                    data=data,
+                    files=files,
+                    tries=tries,
+                    api_key=api_key,
+                    extra_headers=extra_headers,
+                    stream=stream,
+                )
+            elif response.status_code in self.retry_status_codes and tries >= max_tries:
+                sleep(1)
+
+                exception_message = (
+                    "maximum tries reached"
+                    f"url:\n{dest_url}\n\n"
+                    f"response content:\n{str(response.content)}\n\n"
+                    f"response status code:\n{str(response.status_code)}"
+                )
+            else:
+                exception_message = (
+                    f"url:\n{dest_url}\n\n"
+                    f"response content:\n{str(response.content)}\n\n"
+                    f"response status code:\n{str(response.status_code)}"
+                )
+
+            # raise the exception
+            raise Exception(exception_message)
+
+        if cache_key and self.cache_max_entries > 0:
+            self.store_cached_response(cache_key=cache_key, response=response)
+
+        return response
+
+
+def _run_generator_in_context(context: contextvars.Context, function, *args, **kwargs):
+    generator = context.run(function, *args, **kwargs)
+    while True:
+        try:
+            item = context.run(next, generator)
+        except StopIteration:
+            return
+        yield item
+
+
+_default_client = MortaClient()
+_active_client = contextvars.ContextVar("morta_client", default=None)
+
+
+# returns the client the module functions are currently running with:
+# the client activated with MortaClient.activate / MortaClient.run, otherwise the default client
+def get_client() -> MortaClient:
+    client = _active_client.get()
+    return client if client is not None else _default_client
+
+
+# the module functions are thin wrappers which make their api calls through the active client
 def api_call(
     method: str,
     endpoint: str,
@@ -40,87 +340,20 @@ def api_call(
     api_key: str = None,
     data: dict = None,
     files: list = None,
+    extra_headers: dict = None,
+    stream: bool = False,
 ) -> requests.Response:
-    # checking if the method is one of the accepted values
-    assert method in ["GET", "POST", "PUT", "DELETE"], "method should be one of GET, POST, PUT, DELETE"
-
-    if api_key is not None:
-        user_token = api_key
-    else:
-        user_token = DEFAULT_MORTA_USER_TOKEN
-
-    # constructing headers and url
-    headers = {
-        "Accept": "application/json",
-        "Authorization": f"Bearer {user_token}",
-    }
-    dest_url = f"{URL}{endpoint}"
-    # print(f"{method}: {dest_url}")
-
-    # try executing the api request. if failed, wait for 1 second and retry if tries < Max number of tries
-    # otherwise, raise and exception
-    try:
-        if method == "GET":
-            response = requests.get(url=dest_url, headers=headers, params=params)
-        elif method == "POST":
-            if data and files:
-                response = requests.post(url=dest_url, files=files, data=data, headers=headers)
-            elif files:
-                response = requests.post(url=dest_url, files=files, headers=headers)
-            else:
-                response = requests.post(url=dest_url, headers=headers, json=params)
-        elif method == "PUT":
-            response = requests.put(url=dest_url, headers=headers, json=params)
-        elif method == "DELETE":
-            response = requests.delete(url=dest_url, headers=headers, json=params)
-    except Exception:
-        sleep(1)
-        tries = tries + 1
-        if tries < MAX_API_CALL_TRIES:
-            return api_call(method=method, endpoint=endpoint, params=params, data=data, files=files, tries=tries)
-        else:
-            raise Exception(f"Exception:\n{traceback.format_exc()}")
-
-    # if the response code is not 200 or 201:
-    if response.status_code != 200 and response.status_code != 201:
-        # increase the tries and log the response
-        tries = tries + 1
-        log_responses(response)
-        sleep_time = 1
-
-        # if the response status code is one of 502, 500, 503 and max tries have not been reached yet
-        # wait for 1 second, log the response
-        # response 429 happens when more than 10 api calls are made on a resource in a second
-        if response.status_code in [502, 500, 429, 503] and tries < MAX_API_CALL_TRIES:
-            # only for the 429 error, we need to incrementally increase the wait time.
-            if response.status_code in [429]:
-                sleep_time = tries * 2
-
-            sleep(sleep_time)
-            print(f"retrying api call. total tries: {str(tries)}")
-            return api_call(
-                method=method, endpoint=endpoint, params=params, data=data, files=files, tries=tries, api_key=api_key
-            )
-        elif response.status_code in [502, 500, 429, 503] and tries >= MAX_API_CALL_TRIES:
-            sleep(1)
-
-            exception_message = (
-                "maximum tries reached"
-                f"url:\n{dest_url}\n\n"
-                f"response content:\n{str(response.content)}\n\n"
-                f"response status code:\n{str(response.status_code)}"
-            )
-        else:
-            exception_message = (
-                f"url:\n{dest_url}\n\n"
-                f"response content:\n{str(response.content)}\n\n"
-                f"response status code:\n{str(response.status_code)}"
-            )
-
-        # raise the exception
-        raise Exception(exception_message)
-
-    return response
+    return get_client().api_call(
+        method=method,
+        endpoint=endpoint,
+        params=params,
+        tries=tries,
+        api_key=api_key,
+        data=data,
+        files=files,
+        extra_headers=extra_headers,
+        stream=stream,
+    )
 
 
 def log_responses(response: requests.Response):
@@ -484,6 +717,40 @@ def get_table_csv(table_id: str, api_key: str = None) -> str:
     return response.text
 
 
+# take table_id
+# returns the csv export response without reading its content, so that it can be consumed in chunks
+# with response.iter_content or response.raw. close the response (or use it in a with block) when done
+def get_table_csv_stream(table_id: str, api_key: str = None) -> requests.Response:
+    response = api_call("GET", f"/v1/table/{table_id}/csv?", api_key=api_key, stream=True)
+    print(
+        f"get morta table csv stream: {table_id}, "
+        f"response: {str(response.status_code)}, duration: {str(response.elapsed.total_seconds())}"
+    )
+    return response
+
+
+# take table_id
+# writes the csv export straight to disk in chunks instead of holding it in memory
+# if path is not given, a temporary file is created which has to be removed by the caller
+# returns the path of the csv file
+def get_table_csv_to_file(
+    table_id: str, path: str = None, chunk_size: int = FILE_TRANSFER_CHUNK_SIZE, api_key: str = None
+) -> str:
+    if path is None:
+        file_descriptor, path = tempfile.mkstemp(suffix=".csv")
+        os.close(file_descriptor)
+
+    size = 0
+    with get_table_csv_stream(table_id=table_id, api_key=api_key) as response:
+        with open(path, "wb") as file_object:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                file_object.write(chunk)
+                size = size + len(chunk)
+
+    print(f"saved morta table csv: {table_id}, size: {str(size)}, to: {path}")
+    return path
+
+
 # takes:
 #    project_id,
 #    table_name = "table name",
@@ -923,6 +1190,34 @@ def get_table_rows(
     api_key: str = None,
 ) -> list:
     rows = []
+    for page in get_table_row_pages(
+        table_id=table_id,
+        page_size=page_size,
+        filters=filters,
+        wanted_rows=wanted_rows,
+        sort=sort,
+        api_key=api_key,
+    ):
+        rows.extend(page)
+
+    if len(included_column_names) > 0:
+        for row in rows:
+            row["rowData"] = {key: item for key, item in row["rowData"].items() if key in included_column_names}
+
+    return rows
+
+
+# takes the same parameters as get_table_rows (except included_column_names)
+# yields the rows one page at a time, as returned by the api: [{"publicId": "...", "rowData": {...}}]
+# useful to convert or process rows page by page without holding all the row dicts in memory
+def get_table_row_pages(
+    table_id: str,
+    page_size: int = 2500,
+    filters: list = [],
+    wanted_rows: int = -1,
+    sort: list = [],
+    api_key: str = None,
+) -> Iterator[list]:
     token = None
     total = 0
     is_first_page = True
@@ -948,22 +1243,16 @@ def get_table_rows(
         params = {"nextPageToken": token, "size": page_size}
         response = api_call("GET", f"/v1/table/{table_id}/row?{encoded_filter}{encoded_sorts}", params, api_key=api_key)
         json_response = response.json()
-        rows = rows + json_response["data"]
         total += len(json_response["data"])
         print(
             f"get rows from table: {table_id}, total rows: {str(total)}, "
             f"response: {str(response.status_code)}, duration: {str(response.elapsed.total_seconds())}"
         )
         token = json_response["metadata"]["nextPageToken"]
+        yield json_response["data"]
         if wanted_rows > 0 and total >= wanted_rows:
             break
 
-    if len(included_column_names) > 0:
-        for row in rows:
-            row["rowData"] = {key: item for key, item in row["rowData"].items() if key in included_column_names}
-
-    return rows
-
 
 # takes table_id,
 #       page_size=2500 by default,
@@ -1247,6 +1536,294 @@ def upload_file(file: tuple, resource: str = None, resource_id: str = None, api_
     return response.json()["data"]
 
 
+class MultipartFileStream:
+    """
+    A multipart/form-data request body which reads the file while it is being sent,
+    so that the file never has to be held in memory.
+
+    requests sends objects with read() and __len__() in blocks with a Content-Length header.
+    """
+
+    def __init__(
+        self,
+        file_object,
+        file_name: str,
+        mime_type: str = None,
+        fields: dict = None,
+        progress_callback=None,
+    ):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.file_name = file_name
+        self.progress_callback = progress_callback
+
+        if mime_type is None:
+            mime_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+
+        preamble = b""
+        for field_name, field_value in (fields or {}).items():
+            preamble += (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{field_name}"\r\n\r\n'
+                f"{field_value}\r\n"
+            ).encode("utf-8")
+        preamble += (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+            f"Content-Type: {mime_type}\r\n\r\n"
+        ).encode("utf-8")
+        self._preamble = preamble
+        self._epilogue = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+
+        # the file is sent from its current position to its end
+        self._file = file_object
+        self._file_start = file_object.tell()
+        file_object.seek(0, os.SEEK_END)
+        self.file_size = file_object.tell() - self._file_start
+        file_object.seek(self._file_start)
+
+        self._position = 0
+
+    def __len__(self) -> int:
+        return len(self._preamble) + self.file_size + len(self._epilogue)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        # only rewinding is needed (retries and length checks in requests)
+        if whence == os.SEEK_END:
+            offset = len(self) + offset
+        elif whence == os.SEEK_CUR:
+            offset = self._position + offset
+        self._position = max(0, min(offset, len(self)))
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = len(self) - self._position
+
+        chunks = []
+        while size > 0 and self._position < len(self):
+            file_end = len(self._preamble) + self.file_size
+            if self._position < len(self._preamble):
+                chunk = self._preamble[self._position : self._position + size]
+            elif self._position < file_end:
+                self._file.seek(self._file_start + self._position - len(self._preamble))
+                chunk = self._file.read(min(size, file_end - self._position))
+                if not chunk:
+                    raise Exception(f"file {self.file_name} was truncated while uploading")
+            else:
+                epilogue_position = self._position - file_end
+                chunk = self._epilogue[epilogue_position : epilogue_position + size]
+
+            chunks.append(chunk)
+            self._position = self._position + len(chunk)
+            size = size - len(chunk)
+
+            if self.progress_callback and self._position > len(self._preamble):
+                transferred = min(self._position - len(self._preamble), self.file_size)
+                self.progress_callback(self.file_name, transferred, self.file_size)
+
+        return b"".join(chunks)
+
+
+# upload a file object to Morta without reading it into memory
+# takes:
+#   file_object = a file opened in binary mode ("rb")
+#   file_name = the name the file will have in Morta
+#   mime_type (optional) = guessed from the file name if not given
+#   resource (optional) = the type of resource: table, document, etc. (check resources global variable in api.py)
+#   resource_id (optional) = publicId of table or document
+#   progress_callback (optional) = function(file_name, bytes_transferred, total_bytes)
+# returns:
+#   response
+def upload_file_object(
+    file_object,
+    file_name: str,
+    mime_type: str = None,
+    resource: str = None,
+    resource_id: str = None,
+    progress_callback=None,
+    api_key: str = None,
+) -> dict:
+    fields = {}
+    if resource and resource_id:
+        fields["resources"] = json.dumps([{"resource": resource, "publicId": resource_id}])
+
+    body = MultipartFileStream(
+        file_object=file_object,
+        file_name=file_name,
+        mime_type=mime_type,
+        fields=fields,
+        progress_callback=progress_callback,
+    )
+    response = api_call(
+        method="POST",
+        endpoint="/v1/files",
+        data=body,
+        extra_headers={"Content-Type": body.content_type},
+        api_key=api_key,
+    )
+    print(
+        f"upload file: {file_name}, size: {str(body.file_size)}, "
+        f"response: {str(response.status_code)}, duration: {str(response.elapsed.total_seconds())}"
+    )
+    return response.json()["data"]
+
+
+# upload a file from disk to Morta, reading it in chunks while it is sent
+# takes the same parameters as upload_file_object, but with the path of the file
+def upload_file_from_path(
+    path: str,
+    file_name: str = None,
+    mime_type: str = None,
+    resource: str = None,
+    resource_id: str = None,
+    progress_callback=None,
+    api_key: str = None,
+) -> dict:
+    if file_name is None:
+        file_name = os.path.basename(path)
+
+    with open(path, "rb") as file_object:
+        return upload_file_object(
+            file_object=file_object,
+            file_name=file_name,
+            mime_type=mime_type,
+            resource=resource,
+            resource_id=resource_id,
+            progress_callback=progress_callback,
+            api_key=api_key,
+        )
+
+
+# upload several files from disk to Morta concurrently
+# takes a list of paths, returns the upload responses in the same order as the paths
+def upload_files(
+    paths: list,
+    resource: str = None,
+    resource_id: str = None,
+    max_workers: int = MAX_FILE_TRANSFER_WORKERS,
+    progress_callback=None,
+    api_key: str = None,
+) -> list:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                upload_file_from_path,
+                path=path,
+                resource=resource,
+                resource_id=resource_id,
+                progress_callback=progress_callback,
+                api_key=api_key,
+            )
+            for path in paths
+        ]
+        return [future.result() for future in futures]
+
+
+# download a Morta file to disk in chunks
+# takes:
+#   file_url = the url of the file as stored in Morta (it is signed with get_file before downloading)
+#   path (optional) = where to save the file. if not given, a temporary file is created
+#   progress_callback (optional) = function(file_name, bytes_transferred, total_bytes)
+#       total_bytes is None if the server does not send a Content-Length
+# returns:
+#   the path of the downloaded file. temporary files have to be removed by the caller
+def download_file(
+    file_url: str,
+    path: str = None,
+    chunk_size: int = FILE_TRANSFER_CHUNK_SIZE,
+    progress_callback=None,
+    api_key: str = None,
+) -> str:
+    tokenized_url = get_file(file_url=file_url, api_key=api_key)["url"]
+    file_name = os.path.basename(urllib.parse.urlparse(file_url).path)
+
+    if path is None:
+        file_descriptor, path = tempfile.mkstemp(suffix=os.path.splitext(file_name)[1])
+        os.close(file_descriptor)
+
+    transferred = 0
+    with get_client().session.get(url=tokenized_url, stream=True) as response:
+        if response.status_code != 200:
+            raise Exception(
+                f"could not download file: {file_url}\n\n"
+                f"response content:\n{str(response.content)}\n\n"
+                f"response status code:\n{str(response.status_code)}"
+            )
+
+        content_length = response.headers.get("Content-Length")
+        total = int(content_length) if content_length else None
+        with open(path, "wb") as file_object:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                file_object.write(chunk)
+                transferred = transferred + len(chunk)
+                if progress_callback:
+                    progress_callback(file_name, transferred, total)
+
+    print(f"download file: {file_name}, size: {str(transferred)}, to: {path}")
+    return path
+
+
+# download a Morta file and return it as a read-only memory-mapped buffer
+# the buffer behaves like bytes and a binary file (read, seek, slicing) but is paged in from disk
+# the temporary file is removed once mapped (on Windows it is left in the temp folder)
+def download_file_to_mmap(
+    file_url: str,
+    chunk_size: int = FILE_TRANSFER_CHUNK_SIZE,
+    progress_callback=None,
+    api_key: str = None,
+) -> mmap.mmap:
+    path = download_file(file_url=file_url, chunk_size=chunk_size, progress_callback=progress_callback, api_key=api_key)
+    try:
+        with open(path, "rb") as file_object:
+            if os.fstat(file_object.fileno()).st_size == 0:
+                raise Exception(f"downloaded file is empty: {file_url}")
+            buffer = mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return buffer
+
+
+# download several Morta files concurrently
+# takes a list of file urls and optionally the directory to save them in (temporary files otherwise)
+# returns the paths of the downloaded files in the same order as the urls
+def download_files(
+    file_urls: list,
+    directory: str = None,
+    max_workers: int = MAX_FILE_TRANSFER_WORKERS,
+    progress_callback=None,
+    api_key: str = None,
+) -> list:
+    paths = [None] * len(file_urls)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        paths = [
+            os.path.join(directory, f"{str(i)}_{os.path.basename(urllib.parse.urlparse(file_url).path)}")
+            for i, file_url in enumerate(file_urls)
+        ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                download_file,
+                file_url=file_url,
+                path=path,
+                progress_callback=progress_callback,
+                api_key=api_key,
+            )
+            for file_url, path in zip(file_urls, paths)
+        ]
+        return [future.result() for future in futures]
+
+
 # take a string user_keyword : "jad eid" , or can be an email domain "@morta.com"
 # returns a json with a list of all users with names nearly matching that name
 def get_user(
@@ -1647,3 +2224,49 @@ def get_user_achievements(user_firebase_id: str, api_key: str = None) -> dict:
         f"response: {str(response.status_code)}, duration: {str(response.elapsed.total_seconds())}"
     )
     return response.json()
+
+
+# calls the api of a connected system (for example viewpoint) through Morta
+# takes:
+#   method: GET, POST, PUT, DELETE
+#   source_system: the connected system, for example "viewpoint"
+#   endpoint: the full url of the connected system. $token$ is replaced by Morta with the token of the connection
+#   data (optional): the body of the request
+#   headers (optional): headers of the request
+# returns the response, where the response of the connected system is in response.json()["data"]["body"]
+def passthrough(
+    method: str,
+    source_system: str,
+    endpoint: str,
+    data: dict = None,
+    headers: dict = None,
+    api_key: str = None,
+) -> requests.Response:
+    params = {"sourceSystem": source_system, "method": method, "path": endpoint, "data": data, "headers": headers}
+    response = api_call("POST", "/v1/integrations/passthrough", params=params, api_key=api_key)
+    print(
+        f"passthrough to {source_system}: {method} {endpoint}, "
+        f"response: {str(response.status_code)}, duration: {str(response.elapsed.total_seconds())}"
+    )
+    return response
+
+
+# same as passthrough, but returns the file sent by the connected system as the response content
+# with stream=True the content is not read, so that it can be written to disk in chunks
+# with response.iter_content. close the response (or use it in a with block) when done
+def passthrough_download(
+    method: str,
+    source_system: str,
+    endpoint: str,
+    data: dict = None,
+    headers: dict = None,
+    stream: bool = False,
+    api_key: str = None,
+) -> requests.Response:
+    params = {"sourceSystem": source_system, "method": method, "path": endpoint, "data": data, "headers": headers}
+    response = api_call("POST", "/v1/integrations/passthrough-download", params=params, api_key=api_key, stream=stream)
+    print(
+        f"passthrough download from {source_system}: {method} {endpoint}, "
+        f"response: {str(response.status_code)}, duration: {str(response.elapsed.total_seconds())}"
+    )
+    return response
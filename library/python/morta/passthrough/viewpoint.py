@@ -6,8 +6,11 @@ In the backend, Morta will replace this with an actual token from the CDE
 """
 
 # packages
+import os
 import json
+import hashlib
 import requests
+import tempfile
 import pandas as pd
 
 # custom packages
@@ -144,6 +147,47 @@ def get_file(document_id: str, revision_id: str, file_id: str, api_key: str = No
     return response
 
 
+def download_file(
+    document_id: str,
+    revision_id: str,
+    file_id: str,
+    path: str = None,
+    suffix: str = "",
+    chunk_size: int = ma.FILE_TRANSFER_CHUNK_SIZE,
+    api_key: str = None,
+) -> tuple:
+    """
+    Same as get_file, but the file is written to disk in chunks as it is downloaded,
+    instead of being held in memory
+
+    returns (path, sha256 hex digest of the content)
+    path is a new temporary file (ending with suffix) if not given. remove it when done
+    """
+    method = "GET"
+    endpoint = f"{PREFIX_URL}/RevisionFile/{document_id}/{revision_id}/{file_id}?Token=$token$&ParentID={revision_id}"
+
+    if path is None:
+        file_descriptor, path = tempfile.mkstemp(suffix=suffix)
+        os.close(file_descriptor)
+
+    content_hash = hashlib.sha256()
+    try:
+        with ma.passthrough_download(
+            method=method, source_system=SOURCE_SYSTEM, endpoint=endpoint, stream=True, api_key=api_key
+        ) as response:
+            with open(path, "wb") as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+                    content_hash.update(chunk)
+    except Exception:
+        # do not leave a partial file
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    return path, content_hash.hexdigest()
+
+
 def get_resources(
     context_id: str,
     select: list,
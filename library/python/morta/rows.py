@@ -0,0 +1,206 @@
+"""
+Compact row objects for large results of get_table_rows
+
+get_table_rows returns one dict per row, each with a nested rowData dict holding its own copy
+of every column name. Here, all rows of a result share one RowSchema holding the (interned)
+column names, and each Row only keeps its publicId and a tuple of cell values.
+
+Rows can be read like the dicts they replace, so existing code keeps working:
+    row["publicId"]
+    row["rowData"]["Model Name"]
+    row["rowData"].get("Model Name")
+    for column_name, value in row["rowData"].items(): ...
+    row.values(), row.items(), dict(row)
+    "Model Name" in row["rowData"]
+
+Rows are read-only. Use row.to_dict() to get back the dict returned by get_table_rows.
+"""
+
+# packages
+import sys
+from collections.abc import Mapping
+
+# from repo
+import library.python.morta.api as ma
+
+
+class _Missing:
+    """
+    Marks a column which did not exist in the row (as opposed to a cell with a None value)
+    """
+
+    __slots__ = ()
+
+    # rows sent to another process keep pointing to the one marker of that process
+    def __reduce__(self):
+        return "_MISSING"
+
+    def __repr__(self) -> str:
+        return "<missing>"
+
+
+_MISSING = _Missing()
+
+
+class RowSchema:
+    """
+    The column names shared by all the rows of a result set
+    """
+
+    __slots__ = ("column_names", "column_indexes")
+
+    def __init__(self, column_names: list = []):
+        self.column_names = []
+        self.column_indexes = {}
+        for column_name in column_names:
+            self.add_column(column_name=column_name)
+
+    def add_column(self, column_name: str) -> int:
+        column_index = self.column_indexes.get(column_name)
+        if column_index is None:
+            column_index = len(self.column_names)
+            column_name = sys.intern(column_name)
+            self.column_names.append(column_name)
+            self.column_indexes[column_name] = column_index
+        return column_index
+
+    def make_row(self, public_id: str, row_data: dict) -> "Row":
+        for column_name in row_data:
+            if column_name not in self.column_indexes:
+                self.add_column(column_name=column_name)
+        cell_values = tuple(row_data.get(column_name, _MISSING) for column_name in self.column_names)
+        return Row(schema=self, public_id=public_id, cell_values=cell_values)
+
+
+class Row(Mapping):
+    """
+    A read-only row with the keys "publicId" and "rowData", like the dicts returned by get_table_rows
+    """
+
+    # not "values", which would hide Mapping.values()
+    __slots__ = ("schema", "public_id", "cell_values")
+
+    def __init__(self, schema: RowSchema, public_id: str, cell_values: tuple):
+        self.schema = schema
+        self.public_id = public_id
+        self.cell_values = cell_values
+
+    def __getitem__(self, key: str):
+        if key == "publicId":
+            return self.public_id
+        elif key == "rowData":
+            return RowData(row=self)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(("publicId", "rowData"))
+
+    def __len__(self) -> int:
+        return 2
+
+    def __repr__(self) -> str:
+        return f"Row({self.to_dict()})"
+
+    def to_dict(self) -> dict:
+        return {"publicId": self.public_id, "rowData": dict(RowData(row=self))}
+
+
+class RowData(Mapping):
+    """
+    A read-only view of the cells of a Row: {"column name": value}
+    """
+
+    __slots__ = ("row",)
+
+    def __init__(self, row: Row):
+        self.row = row
+
+    def __getitem__(self, column_name: str):
+        column_index = self.row.schema.column_indexes.get(column_name)
+        # rows made before a column was added to the schema have shorter value tuples
+        if column_index is None or column_index >= len(self.row.cell_values):
+            raise KeyError(column_name)
+        value = self.row.cell_values[column_index]
+        if value is _MISSING:
+            raise KeyError(column_name)
+        return value
+
+    def __contains__(self, column_name) -> bool:
+        column_index = self.row.schema.column_indexes.get(column_name)
+        if column_index is None or column_index >= len(self.row.cell_values):
+            return False
+        return self.row.cell_values[column_index] is not _MISSING
+
+    def __iter__(self):
+        for column_name, value in zip(self.row.schema.column_names, self.row.cell_values):
+            if value is not _MISSING:
+                yield column_name
+
+    def __len__(self) -> int:
+        return sum(1 for value in self.row.cell_values if value is not _MISSING)
+
+    def items(self):
+        for column_name, value in zip(self.row.schema.column_names, self.row.cell_values):
+            if value is not _MISSING:
+                yield column_name, value
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+
+def compact_rows(rows: list, schema: RowSchema = None) -> list:
+    """
+    Purpose
+    -------
+    Converts rows as returned by get_table_rows to compact Row objects sharing one schema
+
+    Input
+    -----
+    - rows: [{"publicId": "...", "rowData": {"column name": value}}]
+    - schema: optional RowSchema to share with other rows
+
+    Output
+    ------
+    - list of Row
+    """
+    if schema is None:
+        schema = RowSchema()
+    return [schema.make_row(public_id=row["publicId"], row_data=row["rowData"]) for row in rows]
+
+
+def get_table_rows_compact(
+    table_id: str,
+    page_size: int = 2500,
+    included_column_names: list = [],
+    filters: list = [],
+    wanted_rows: int = -1,
+    sort: list = [],
+    api_key: str = None,
+) -> list:
+    """
+    Purpose
+    -------
+    Same as morta.api.get_table_rows, but each page is converted to compact Row objects
+    as soon as it arrives, so the row dicts of only one page are held in memory at a time
+
+    Output
+    ------
+    - list of Row, sharing one RowSchema
+    """
+    rows = []
+    schema = RowSchema()
+    for page in ma.get_table_row_pages(
+        table_id=table_id,
+        page_size=page_size,
+        filters=filters,
+        wanted_rows=wanted_rows,
+        sort=sort,
+        api_key=api_key,
+    ):
+        for row in page:
+            row_data = row["rowData"]
+            if len(included_column_names) > 0:
+                row_data = {key: item for key, item in row_data.items() if key in included_column_names}
+            rows.append(schema.make_row(public_id=row["publicId"], row_data=row_data))
+
+    return rows
@@ -0,0 +1,133 @@
+"""
+Column by column construction of large dataframes
+
+Building a dataframe from a list of dicts keeps every dict, with its own copy of every key,
+until the dataframe is made. ColumnarBuilder instead appends each row into per-column buffers
+as soon as it is produced:
+- only the cells a row actually has are stored (row index + value), missing cells cost nothing
+- equal strings are stored once
+- low-cardinality text columns can become pandas categoricals (to_dataframe(categorical=True))
+
+    builder = ColumnarBuilder()
+    for element in elements:
+        builder.append(row=extract_element(element=element))
+    df = builder.to_dataframe()
+"""
+
+# packages
+from array import array
+import numpy as np
+import pandas as pd
+
+
+class ColumnarBuilder:
+    def __init__(self, column_names: list = []):
+        self.row_count = 0
+        # column name -> (row indices, values)
+        self.columns = {}
+        # one object per distinct string value
+        self.strings = {}
+        for column_name in column_names:
+            self.get_column(column_name=column_name)
+
+    def __len__(self) -> int:
+        return self.row_count
+
+    # the string dedupe dict is not needed to send a builder to another process:
+    # pickle already stores each shared string object once
+    def __getstate__(self) -> dict:
+        return {"row_count": self.row_count, "columns": self.columns}
+
+    def __setstate__(self, state: dict):
+        self.row_count = state["row_count"]
+        self.columns = state["columns"]
+        self.strings = {}
+
+    def get_column(self, column_name: str) -> tuple:
+        column = self.columns.get(column_name)
+        if column is None:
+            column = (array("q"), [])
+            self.columns[column_name] = column
+        return column
+
+    def dedupe(self, value):
+        if type(value) is str:
+            return self.strings.setdefault(value, value)
+        return value
+
+    def append(self, row: dict):
+        """
+        Appends one row: {"column name": value}
+        """
+        row_index = self.row_count
+        for column_name, value in row.items():
+            indices, values = self.get_column(column_name=column_name)
+            indices.append(row_index)
+            values.append(self.dedupe(value=value))
+        self.row_count = row_index + 1
+
+    def extend(self, other: "ColumnarBuilder", constants: dict = {}):
+        """
+        Appends all the rows of another builder, and optionally sets constant columns on them
+        (for example the name of the file the rows were extracted from)
+        """
+        offset = self.row_count
+        for column_name, value in constants.items():
+            indices, values = self.get_column(column_name=column_name)
+            indices.extend(range(offset, offset + other.row_count))
+            values.extend([self.dedupe(value=value)] * other.row_count)
+
+        for column_name, (other_indices, other_values) in other.columns.items():
+            indices, values = self.get_column(column_name=column_name)
+            indices.extend(index + offset for index in other_indices)
+            values.extend(self.dedupe(value=value) for value in other_values)
+        self.row_count = offset + other.row_count
+
+    def to_dataframe(
+        self, categorical: bool = False, category_max_ratio: float = 0.5
+    ) -> pd.DataFrame:
+        """
+        Purpose
+        ----------
+        Makes the dataframe of the rows appended so far.
+
+        Missing cells are NaN, like pd.DataFrame(data=list_of_dicts).
+
+        Parameters
+        ----------
+        - categorical: convert low-cardinality text columns to the pandas category dtype
+          (off by default: category columns do not accept new values in fillna or assignments)
+        - category_max_ratio: a text column is low-cardinality if its number of distinct values
+          is at most category_max_ratio times its number of values
+
+        Output
+        ----------
+        - pandas dataframe
+        """
+        data = {}
+        for column_name, (indices, values) in self.columns.items():
+            if categorical and is_low_cardinality_text(
+                values=values, max_ratio=category_max_ratio
+            ):
+                categories = sorted(set(values))
+                category_codes = {value: code for code, value in enumerate(categories)}
+                codes = np.full(self.row_count, -1, dtype=np.int32)
+                codes[np.frombuffer(indices, dtype=np.int64)] = [
+                    category_codes[value] for value in values
+                ]
+                data[column_name] = pd.Categorical.from_codes(
+                    codes=codes, categories=categories
+                )
+            else:
+                column = [np.nan] * self.row_count
+                for index, value in zip(indices, values):
+                    column[index] = value
+                data[column_name] = column
+
+        return pd.DataFrame(data=data, index=pd.RangeIndex(self.row_count))
+
+
+def is_low_cardinality_text(values: list, max_ratio: float) -> bool:
+    if len(values) == 0 or not all(type(value) is str for value in values):
+        return False
+    return len(set(values)) <= max_ratio * len(values)
@@ -1,11 +1,18 @@
 # packages
 import os
 import json
-import requests
 import tempfile
+from typing import Iterator
 import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 # from repo
 import library.python.morta.api as ma
 
@@ -26,6 +33,418 @@ def morta_rows_to_dataframe(
     return df
 
 
+# convert one page of morta rows to columns: {"column name": [value, ...]}
+# column names are taken once per page instead of being repeated in every row
+def morta_rows_to_columns(
+    input_morta_rows: list,
+    with_row_id: bool = False,
+    included_column_names: list = [],
+) -> dict:
+    column_names = {}
+    for row in input_morta_rows:
+        for column_name in row["rowData"]:
+            column_names[column_name] = None
+    if len(included_column_names) > 0:
+        column_names = {
+            column_name: None
+            for column_name in column_names
+            if column_name in included_column_names
+        }
+
+    columns = {
+        column_name: [row["rowData"].get(column_name) for row in input_morta_rows]
+        for column_name in column_names
+    }
+    if with_row_id:
+        columns["rowId"] = [row["publicId"] for row in input_morta_rows]
+    return columns
+
+
+def get_table_rows_as_dataframe(
+    table_id: str,
+    included_column_names: list = [],
+    filters: list = [],
+    wanted_rows: int = -1,
+    sort: list = [],
+    with_row_id: bool = False,
+    page_size: int = 2500,
+    api_key: str = None,
+) -> pd.DataFrame:
+    """
+    Purpose
+    ----------
+    Gets the rows of a Morta table straight into pandas columns.
+
+    Each page is decoded into per-column lists and dropped, so the list of row dicts
+    returned by get_table_rows is never built. The result is the same as
+    morta_rows_to_dataframe(get_table_rows(...)).
+
+    Parameters
+    ----------
+    - same as morta.api.get_table_rows
+    - with_row_id: add the row publicId as a "rowId" column
+
+    Output
+    ----------
+    - pandas dataframe
+    """
+    columns = {}
+    row_count = 0
+
+    for page in ma.get_table_row_pages(
+        table_id=table_id,
+        page_size=page_size,
+        filters=filters,
+        wanted_rows=wanted_rows,
+        sort=sort,
+        api_key=api_key,
+    ):
+        page_columns = morta_rows_to_columns(
+            input_morta_rows=page,
+            with_row_id=with_row_id,
+            included_column_names=included_column_names,
+        )
+        # columns seen for the first time are filled with None for the previous pages
+        for column_name, values in page_columns.items():
+            if column_name not in columns:
+                columns[column_name] = [None] * row_count
+            columns[column_name].extend(values)
+        row_count = row_count + len(page)
+        # columns missing from this page are filled with None
+        for values in columns.values():
+            if len(values) < row_count:
+                values.extend([None] * (row_count - len(values)))
+
+    return pd.DataFrame(data=columns)
+
+
+def get_table_rows_as_arrow(
+    table_id: str,
+    included_column_names: list = [],
+    filters: list = [],
+    wanted_rows: int = -1,
+    sort: list = [],
+    with_row_id: bool = False,
+    page_size: int = 2500,
+    api_key: str = None,
+):
+    """
+    Purpose
+    ----------
+    Gets the rows of a Morta table as a pyarrow Table.
+
+    Each page is decoded into an Arrow record batch as soon as it arrives, so column names
+    are stored once per batch and values in typed column buffers.
+    Use .to_pandas() on the result to get a dataframe.
+
+    Needs the optional pyarrow package.
+
+    Parameters
+    ----------
+    - same as get_table_rows_as_dataframe
+
+    Output
+    ----------
+    - pyarrow.Table
+    """
+    if pa is None:
+        raise Exception(
+            "pyarrow is required to get table rows as arrow: pip install pyarrow"
+        )
+
+    tables = []
+    for page in ma.get_table_row_pages(
+        table_id=table_id,
+        page_size=page_size,
+        filters=filters,
+        wanted_rows=wanted_rows,
+        sort=sort,
+        api_key=api_key,
+    ):
+        if len(page) == 0:
+            continue
+        page_columns = morta_rows_to_columns(
+            input_morta_rows=page,
+            with_row_id=with_row_id,
+            included_column_names=included_column_names,
+        )
+        arrays = [
+            values_to_arrow_array(values=values) for values in page_columns.values()
+        ]
+        batch = pa.RecordBatch.from_arrays(arrays, names=list(page_columns.keys()))
+        tables.append(pa.Table.from_batches([batch]))
+
+    if len(tables) == 0:
+        return pa.table({})
+
+    # pages can differ in columns (missing columns) or in inferred types (all null, or numbers in one page
+    # and text in the next), so each column gets one type for all the pages before they are concatenated
+    tables = unify_column_types(tables=tables)
+    return pa.concat_tables(tables, promote_options="permissive")
+
+
+def values_to_arrow_array(values: list):
+    """
+    Converts a list of cell values to a pyarrow array.
+
+    Values that do not share one arrow type (for example text and numbers in the same column)
+    are converted to text, see value_to_text.
+    """
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array(
+            [value_to_text(value=value) for value in values], type=pa.string()
+        )
+
+
+def value_to_text(value):
+    # text stays as it is, other values (numbers, booleans, lists, dicts) become json text
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+
+def unify_column_types(tables: list) -> list:
+    """
+    Purpose
+    ----------
+    Casts the columns of tables (the pages of one table) so that each column has the same type
+    in all the tables:
+    - columns which are null in some tables, or integers in some and decimals in others, are promoted
+    - columns with conflicting types (for example numbers and text, or lists and text) become text
+
+    Parameters
+    ----------
+    - tables: list of pyarrow.Table
+
+    Output
+    ----------
+    - list of pyarrow.Table
+    """
+    column_types = {}
+    for table in tables:
+        for field in table.schema:
+            column_types.setdefault(field.name, []).append(field.type)
+
+    target_types = {}
+    for column_name, types in column_types.items():
+        try:
+            schema = pa.unify_schemas(
+                [
+                    pa.schema([pa.field(column_name, column_type)])
+                    for column_type in types
+                ],
+                promote_options="permissive",
+            )
+            target_types[column_name] = schema.field(column_name).type
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            target_types[column_name] = pa.string()
+
+    unified_tables = []
+    for table in tables:
+        arrays = []
+        for field, column in zip(table.schema, table.columns):
+            target_type = target_types[field.name]
+            if field.type == target_type:
+                arrays.append(column)
+            elif target_type == pa.string() and not pa.types.is_null(field.type):
+                arrays.append(
+                    pa.array(
+                        [value_to_text(value=value) for value in column.to_pylist()],
+                        type=pa.string(),
+                    )
+                )
+            else:
+                arrays.append(column.cast(target_type))
+        unified_tables.append(pa.Table.from_arrays(arrays, names=table.column_names))
+    return unified_tables
+
+
+def dataframe_to_arrow(input_df: pd.DataFrame):
+    """
+    Purpose
+    ----------
+    Converts a dataframe to a pyarrow Table which can be written to parquet.
+
+    Columns whose values do not share one arrow type (for example text and numbers, or lists)
+    are stored as json text, and listed in the "json_columns" schema metadata so that
+    arrow_to_dataframe can decode them.
+
+    Needs the optional pyarrow package.
+
+    Parameters
+    ----------
+    - input_df: pandas dataframe with text column names
+
+    Output
+    ----------
+    - pyarrow.Table
+    """
+    if pa is None:
+        raise Exception("pyarrow is required to convert to arrow: pip install pyarrow")
+
+    arrays = []
+    json_columns = []
+    for column_name in input_df.columns:
+        values = input_df[column_name]
+        try:
+            arrays.append(pa.array(values, from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(
+                pa.array(
+                    [
+                        None if is_missing(value) else json.dumps(value, default=str)
+                        for value in values
+                    ],
+                    type=pa.string(),
+                )
+            )
+            json_columns.append(column_name)
+
+    table = pa.Table.from_arrays(arrays, names=[str(name) for name in input_df.columns])
+    return table.replace_schema_metadata({"json_columns": json.dumps(json_columns)})
+
+
+def arrow_to_dataframe(table) -> pd.DataFrame:
+    """
+    Converts a pyarrow Table made by dataframe_to_arrow back to a dataframe.
+    Missing values come back as None or NaN, which pandas treats the same (isna, to_json).
+    """
+    metadata = table.schema.metadata or {}
+    json_columns = json.loads(metadata.get(b"json_columns", b"[]"))
+
+    df = table.to_pandas()
+    for column_name in json_columns:
+        df[column_name] = [
+            json.loads(value) if isinstance(value, str) else np.nan
+            for value in df[column_name]
+        ]
+    return df
+
+
+def is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def chunk_to_dataframe(chunk) -> pd.DataFrame:
+    # chunks can be dataframes or pyarrow tables / record batches
+    if isinstance(chunk, pd.DataFrame):
+        return chunk
+    if pa is None:
+        raise Exception("pyarrow is required to read arrow chunks: pip install pyarrow")
+    if isinstance(chunk, pa.RecordBatch):
+        chunk = pa.Table.from_batches([chunk])
+    return arrow_to_dataframe(table=chunk)
+
+
+def write_chunks_to_parquet(
+    chunks: Iterator, directory: str, file_prefix: str = "part"
+) -> list:
+    """
+    Purpose
+    ----------
+    Writes each chunk (dataframe or pyarrow table) to its own parquet file in a directory,
+    so only one chunk is in memory at a time.
+    Chunks do not need to have the same columns. Read them back with read_parquet_files.
+
+    Needs the optional pyarrow package.
+
+    Parameters
+    ----------
+    - chunks: iterator of dataframes or pyarrow tables, for example from iter_extract_ifc_file
+    - directory: created if it does not exist
+    - file_prefix: files are named {file_prefix}-00000.parquet, {file_prefix}-00001.parquet, ...
+
+    Output
+    ----------
+    - list of the written file paths
+    """
+    if pq is None:
+        raise Exception(
+            "pyarrow is required to write parquet files: pip install pyarrow"
+        )
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for chunk in chunks:
+        if isinstance(chunk, pd.DataFrame):
+            chunk = dataframe_to_arrow(input_df=chunk)
+        elif isinstance(chunk, pa.RecordBatch):
+            chunk = pa.Table.from_batches([chunk])
+        path = os.path.join(directory, f"{file_prefix}-{len(paths):05d}.parquet")
+        pq.write_table(chunk, path)
+        paths.append(path)
+    return paths
+
+
+def read_parquet_files(paths: list) -> pd.DataFrame:
+    """
+    Reads the parquet files written by write_chunks_to_parquet into one dataframe
+    """
+    if pq is None:
+        raise Exception(
+            "pyarrow is required to read parquet files: pip install pyarrow"
+        )
+
+    dfs = [arrow_to_dataframe(table=pq.read_table(path)) for path in paths]
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    return pd.concat(objs=dfs, ignore_index=True)
+
+
+def write_chunks_to_ndjson(chunks: Iterator, path: str) -> int:
+    """
+    Purpose
+    ----------
+    Writes chunks (dataframes or pyarrow tables) to a newline delimited json file,
+    one json object per row, appending each chunk as it arrives.
+
+    Output
+    ----------
+    - number of rows written
+    """
+    row_count = 0
+    with open(path, "w", encoding="utf-8") as file:
+        for chunk in chunks:
+            df = chunk_to_dataframe(chunk=chunk)
+            if df.empty:
+                continue
+            text = df.to_json(orient="records", lines=True, default_handler=str)
+            file.write(text if text.endswith("\n") else f"{text}\n")
+            row_count = row_count + len(df)
+    return row_count
+
+
+def insert_chunks_into_table(
+    chunks: Iterator,
+    table_id: str,
+    insert_row_count: int = 2000,
+    api_key: str = None,
+) -> int:
+    """
+    Purpose
+    ----------
+    Inserts chunks (dataframes or pyarrow tables) into a Morta table as they arrive,
+    so the rows of only one chunk are held in memory at a time.
+
+    Output
+    ----------
+    - number of rows inserted
+    """
+    row_count = 0
+    for chunk in chunks:
+        rows = dataframe_to_morta_rows(input_df=chunk_to_dataframe(chunk=chunk))
+        ma.insert_rows(
+            table_id=table_id,
+            rows=rows,
+            insert_row_count=insert_row_count,
+            api_key=api_key,
+        )
+        row_count = row_count + len(rows)
+    return row_count
+
+
 # convert dataframe to morta rows:
 # takes in a dataframe consisting of columns and rows
 # outputs a list of morta rowData format (can be used for insert, update rows, upsert)
@@ -71,6 +490,39 @@ def dataframe_to_morta_update_cells(
     return update_cells
 
 
+def get_table_csv_chunks(
+    table_id: str, chunk_size: int = 50000, dtype=None, api_key: str = None
+) -> Iterator[pd.DataFrame]:
+    """
+    Purpose
+    ----------
+    Reads the csv export of a Morta table as it is being downloaded and yields it as dataframes
+    of at most chunk_size rows, so the export is never held in memory as one string.
+
+    The csv is parsed with the pandas C engine, which is the fast engine that supports chunked reads.
+
+    Parameters
+    ----------
+    - table_id: publicId of the Morta table
+    - chunk_size: maximum number of rows per dataframe
+    - dtype: passed to pandas.read_csv, use str to keep every value as text
+    - api_key: Morta api key
+
+    Output
+    ----------
+    - iterator of pandas dataframes
+    """
+    with ma.get_table_csv_stream(table_id=table_id, api_key=api_key) as response:
+        # let urllib3 undo any gzip/deflate transfer encoding while pandas reads
+        response.raw.decode_content = True
+        reader = pd.read_csv(
+            response.raw, chunksize=chunk_size, dtype=dtype, engine="c"
+        )
+        with reader:
+            for chunk in reader:
+                yield chunk
+
+
 def convert_csv_to_pandas(path: str) -> pd.DataFrame:
     dirname = os.path.dirname(os.path.realpath(__file__))
     file_name = os.path.join(dirname, path)
@@ -139,26 +591,40 @@ def get_columns_not_in_df(df: pd.DataFrame, columns: list) -> list:
 
 
 def get_workbook_from_json(file_json: dict) -> pd.ExcelFile:
-    tokenized_url = ma.get_file(file_json["url"])["url"]
-    binary_file = requests.get(tokenized_url).content
     if file_json["extension"] == "xls":
-        return pd.ExcelFile(binary_file, engine="xlrd")
+        engine = "xlrd"
     elif file_json["extension"] == "xlsx":
-        return pd.ExcelFile(binary_file, engine="openpyxl")
+        engine = "openpyxl"
     else:
         raise Exception(
             f"Expected xslx or xls extension file. Received: {file_json['extension']}"
         )
 
+    # stream the file to disk instead of holding the whole download in memory
+    path = ma.download_file(file_url=file_json["url"])
+    workbook = pd.ExcelFile(path, engine=engine)
+
+    # the workbook keeps its own handle to the file, so the path can be removed
+    # (on Windows the open file cannot be removed and stays in the temp folder)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    return workbook
+
 
 def get_dataframe_from_csv(file_json: dict) -> pd.DataFrame:
-    tokenized_url = ma.get_file(file_json["url"])["url"]
-    if file_json["extension"] == "csv":
-        try:
-            return pd.read_csv(filepath_or_buffer=tokenized_url)
-        except Exception:
-            return pd.read_csv(filepath_or_buffer=tokenized_url, encoding="latin1")
-    else:
+    if file_json["extension"] != "csv":
         raise Exception(
             f"Expected csv extension in file. Received: {file_json['extension']}"
         )
+
+    # download once and parse from disk, so the latin1 fallback does not download it again
+    path = ma.download_file(file_url=file_json["url"])
+    try:
+        try:
+            return pd.read_csv(filepath_or_buffer=path)
+        except Exception:
+            return pd.read_csv(filepath_or_buffer=path, encoding="latin1")
+    finally:
+        os.remove(path)
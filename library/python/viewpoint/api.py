@@ -123,14 +123,26 @@ def get_token(user_name: str, password: str, application_id: str) -> str:
 
 
 def upload_file_to_document_revision(
-    document_id: str, revision_id: str, file_name: str, is_primary_file: str, token: str, bytes_object: bytes
+    document_id: str,
+    revision_id: str,
+    file_name: str,
+    is_primary_file: str,
+    token: str,
+    bytes_object: bytes = None,
+    file_path: str = None,
 ) -> dict:
+    # the file content is either bytes_object, or the file at file_path
+    # a file is streamed from disk (with its Content-Length), so it is never held in memory
     endpoint = (
         f"https://api.4projects.com/API/RevisionFile/{document_id}/{revision_id}?FileName={file_name}"
         f"&IsPrimaryFile={is_primary_file}&Token={token}"
     )
     headers = {"Content-Type": "application/octet-stream"}
-    response = requests.post(url=endpoint, headers=headers, data=bytes_object)
+    if file_path:
+        with open(file_path, "rb") as file:
+            response = requests.post(url=endpoint, headers=headers, data=file)
+    else:
+        response = requests.post(url=endpoint, headers=headers, data=bytes_object)
     return response.json()
 
 